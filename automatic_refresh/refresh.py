@@ -11,6 +11,7 @@
 #########################################################################################
 
 import sys, os
+import fcntl
 import logging
 import logging.config
 from optparse import OptionParser
@@ -26,7 +27,7 @@ sys.path.append(os.path.join(current_directory, 'met'))
 os.environ['DJANGO_SETTINGS_MODULE'] = 'met.settings'
 
 import django
-from met.metadataparser.refresh_metadata import refresh
+from met.metadataparser.refresh_metadata import refresh, refresh_status
 
 django.setup()
 
@@ -40,24 +41,28 @@ class SingleRun(object):
 
     def __call__(self, func):
         def fnc(*args, **kwargs):
-            if os.path.exists(self.lock_file):
-                #get process id, if lock file exists
-                pid = open(self.lock_file, "rt").read()
-                if not os.path.exists("/proc/%s" % pid):
-                    #if process is not alive remove the lock file
-                    os.unlink(self.lock_file)
-                else:
-                    #process is running
-                    raise self.InstanceRunningException(pid)
+            # The lock is released by the system when the process dies,
+            # even if it is killed, so a stale lock file never blocks a run
+            lock = open(self.lock_file, "a+")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                lock.seek(0)
+                pid = lock.read()
+                lock.close()
+                raise self.InstanceRunningException(pid)
 
             try:
                 #store process id
-                open(self.lock_file, "wt").write(str(os.getpid()))
+                lock.truncate(0)
+                lock.write(str(os.getpid()))
+                lock.flush()
                 #execute wrapped function
                 func(*args,**kwargs)
             finally:
-                if os.path.exists(self.lock_file):
-                    os.unlink(self.lock_file)
+                lock.truncate(0)
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
         return fnc
 
 class RefreshMetaData(object):
@@ -65,6 +70,9 @@ class RefreshMetaData(object):
     def process(cls, options):
         fed_name = options.fed_name
         force_refresh = options.force_refresh
+        workers = options.workers
+        concurrency = options.concurrency
+        resume = options.resume
         
         logger = None
         if options.log:
@@ -72,15 +80,22 @@ class RefreshMetaData(object):
             logger = logging.getLogger("Refresh")
     
         try:
-            refresh(fed_name, force_refresh, logger)
+            if options.status:
+                refresh_status(fed_name, logger)
+            else:
+                refresh(fed_name, force_refresh, logger, workers, concurrency, resume)
         except Exception as e:
             if logger:
 	        logger.error("%s" % e)
 
 @SingleRun(lock_file="met-metadatarefresh")
+def locked_process(convert_class, options):
+    obj_convert = convert_class()
+    obj_convert.process(options)
+
 def commandline_call(convert_class=RefreshMetaData):
     opt_parser = OptionParser()
-    opt_parser.set_usage("refresh [--federation <fed_name>] [--log  <file>] [--force-refresh]")
+    opt_parser.set_usage("refresh [--federation <fed_name>] [--log  <file>] [--force-refresh] [--workers <num>] [--concurrency <num>] [--resume | --status]")
     
     opt_parser.add_option(
         "-l",
@@ -108,19 +123,64 @@ def commandline_call(convert_class=RefreshMetaData):
         help="Force refresh of metadata information (even if file has not changed)",
         metavar="REF")
 
+    opt_parser.add_option(
+        "-w",
+        "--workers",
+        type="int",
+        dest="workers",
+        help="Number of processes extracting entity data (default: 1)",
+        default=None,
+        metavar="WORKERS")
+
+    opt_parser.add_option(
+        "-c",
+        "--concurrency",
+        type="int",
+        dest="concurrency",
+        help="Number of federations refreshed at the same time (default: 1)",
+        default=None,
+        metavar="CONCURRENCY")
+
+    opt_parser.add_option(
+        "-R",
+        "--resume",
+        action="store_true",
+        dest="resume",
+        help="Refresh only the federations not completed by the last run",
+        metavar="RESUME")
+
+    opt_parser.add_option(
+        "-s",
+        "--status",
+        action="store_true",
+        dest="status",
+        help="Show the progress of the last refresh and exit",
+        metavar="STATUS")
+
     (options, _) = opt_parser.parse_args()
     
     error_message = ""
     if options.log and not os.path.exists(options.log):
         error_message = "File '%s' does not exist." % options.log
+    elif options.workers is not None and options.workers < 1:
+        error_message = "Number of workers must be a positive integer."
+    elif options.concurrency is not None and options.concurrency < 1:
+        error_message = "Concurrency must be a positive integer."
+    elif options.workers > 1 and options.concurrency > 1:
+        error_message = "Options --workers and --concurrency are mutually exclusive."
+    elif options.resume and options.status:
+        error_message = "Options --resume and --status are mutually exclusive."
     
     if error_message:
         print(error_message)
         print(opt_parser.get_usage())
         exit (1)
     
-    obj_convert = convert_class()
-    obj_convert.process(options)
+    if options.status:
+        # The status can be shown while a refresh is running
+        convert_class().process(options)
+    else:
+        locked_process(convert_class, options)
 
 if __name__ == '__main__':
     log_args = {'level': logging.ERROR}
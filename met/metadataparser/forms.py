@@ -174,13 +174,6 @@ class ChartForm(forms.Form):
                 errors = ErrorDict()
                 errors['toDate'] = 'End date must not be before Start date'
                 self._errors = errors
-            else:
-                result = (self.cleaned_data['toDate'] -
-                          self.cleaned_data['fromDate']).days < 12
-                if not result:
-                    errors = ErrorDict()
-                    errors['fromDate'] = 'The maximum number of days shown in the chart is 11 days'
-                    self._errors = errors
 
         return result
 
@@ -293,6 +286,10 @@ class SearchEntitiesForm(forms.Form):
 
     page = forms.IntegerField(min_value=0, initial=1, required=False,
                               widget=forms.HiddenInput(attrs={'id': 'pagination_page'}))
+    after = forms.CharField(max_length=200, required=False,
+                            widget=forms.HiddenInput(attrs={'id': 'pagination_after'}))
+    before = forms.CharField(max_length=200, required=False,
+                             widget=forms.HiddenInput(attrs={'id': 'pagination_before'}))
     export_format = forms.CharField(
         required=False, widget=forms.HiddenInput(attrs={'id': 'export_format'}))
 
@@ -0,0 +1,97 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+##########################################################################
+
+import timeit
+from optparse import make_option
+
+from lxml import etree
+from django.core.management.base import BaseCommand, CommandError
+
+from met.metadataparser import xmlparser
+from met.metadataparser.xmlparser import MetadataParser, NAMESPACES, XPATHS
+
+
+class InterpretedXPath(object):
+    """
+    Evaluates an XPath expression from its source string at every call,
+    as the extractors did before XPATHS was introduced.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, element, **variables):
+        return element.xpath(self.path, namespaces=NAMESPACES, **variables)
+
+
+class Command(BaseCommand):
+    args = '<metadata file>'
+    help = ('Measures per-entity extraction time of the per-feature extractors, with interpreted '
+            'and precompiled XPath expressions, and of the single traversal extractor')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--limit', type='int', dest='limit', default=None,
+                    help='Number of entities to read from the file (default: all)'),
+        make_option('--repeat', type='int', dest='repeat', default=3,
+                    help='Number of timed runs for each mode, the best one is reported'),
+        make_option('--no-details', action='store_false', dest='details', default=True,
+                    help='Extract only the attributes used during refresh'),
+    )
+
+    def _load_elements(self, filename, limit):
+        elements = []
+        context = etree.iterparse(filename, tag=xmlparser.ENTITY_ROOT_TAG, events=('end',),
+                                  huge_tree=True, remove_blank_text=True)
+        for _, element in context:
+            elements.append(element)
+            if limit and len(elements) >= limit:
+                break
+        return elements
+
+    def _time_extraction(self, extractor, elements, details, repeat):
+        def extract():
+            for element in elements:
+                extractor(element, details)
+        return min(timeit.repeat(extract, number=1, repeat=repeat))
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: benchmark_parser %s' % self.args)
+
+        elements = self._load_elements(args[0], options['limit'])
+        if not elements:
+            raise CommandError('No entity found in %s' % args[0])
+
+        compiled = dict(XPATHS)
+        interpreted = dict((name, InterpretedXPath(xpath.path))
+                           for name, xpath in compiled.items())
+
+        modes = (
+            ('interpreted', MetadataParser._get_entity_by_features, interpreted),
+            ('compiled', MetadataParser._get_entity_by_features, compiled),
+            ('single-pass', MetadataParser._get_entity_single_pass, compiled),
+        )
+
+        timings = {}
+        try:
+            for mode, extractor, xpaths in modes:
+                XPATHS.update(xpaths)
+                timings[mode] = self._time_extraction(
+                    extractor, elements, options['details'], options['repeat'])
+        finally:
+            XPATHS.update(compiled)
+
+        self.stdout.write('Entities: %d' % len(elements))
+        for mode, _, _ in modes:
+            self.stdout.write('%-12s %8.3f s total, %8.1f us per entity, speedup %.2fx' % (
+                mode, timings[mode], timings[mode] * 1e6 / len(elements),
+                timings['interpreted'] / timings[mode]))
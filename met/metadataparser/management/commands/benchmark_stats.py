@@ -0,0 +1,144 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+##########################################################################
+
+import timeit
+from datetime import date, datetime, timedelta
+from optparse import make_option
+
+import pytz
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Max
+
+from met.metadataparser.models import Federation, EntityStat, DailyStat
+
+BENCHMARK_PREFIX = 'benchmark-stats-'
+
+
+class Command(BaseCommand):
+    help = ('Seeds years of daily statistics for benchmark federations and measures the '
+            'latency of the statistics queries of the chart pages and of the refresh, '
+            'optionally also without the EntityStat composite indexes')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--federations', type='int', dest='federations', default=10,
+                    help='Number of benchmark federations to seed'),
+        make_option('--years', type='int', dest='years', default=10,
+                    help='Years of daily statistics seeded for every federation'),
+        make_option('--days', type='int', dest='days', default=11,
+                    help='Number of days read by the chart queries'),
+        make_option('--repeat', type='int', dest='repeat', default=5,
+                    help='Number of timed runs for each query, the best one is reported'),
+        make_option('--compare', action='store_true', dest='compare', default=False,
+                    help='Measure also without the EntityStat composite indexes'),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+                    help='Do not remove the benchmark federations at the end'),
+    )
+
+    def _seed(self, federations, years):
+        features = settings.STATS['features'].keys()
+        first_day = date.today() - timedelta(days=365 * years)
+        days = [first_day + timedelta(n) for n in range((date.today() - first_day).days)]
+
+        for count, federation in enumerate(federations):
+            entity_stats = []
+            daily_stats = []
+            for n, day in enumerate(days):
+                stat_time = pytz.utc.localize(datetime.combine(day, datetime.min.time()))
+                daily_stat = DailyStat(federation=federation, date=day)
+                for feature in features:
+                    value = (n + count) % 1000
+                    entity_stats.append(EntityStat(federation=federation, feature=feature,
+                                                   time=stat_time, value=value))
+                    if feature in DailyStat.FEATURES:
+                        setattr(daily_stat, feature, value)
+                daily_stats.append(daily_stat)
+
+            with transaction.atomic():
+                EntityStat.objects.bulk_create(entity_stats, batch_size=500)
+                DailyStat.objects.bulk_create(daily_stats, batch_size=500)
+            self.stdout.write('Seeded %d statistics for %s' % (len(entity_stats), federation))
+
+    def _queries(self, federations, days):
+        terms = settings.STATS['statistics']['entity_by_type']['terms']
+        to_day = date.today() - timedelta(days=365)
+        from_day = to_day - timedelta(days=days)
+        from_time = pytz.utc.localize(datetime.combine(from_day, datetime.min.time()))
+        to_time = pytz.utc.localize(datetime.combine(to_day, datetime.min.time()))
+
+        def chart():
+            for federation in federations:
+                list(EntityStat.objects.filter(federation=federation, feature__in=terms,
+                                               time__gte=from_time, time__lte=to_time).order_by('time'))
+
+        def daily_chart():
+            for federation in federations:
+                list(DailyStat.objects.filter(federation=federation, date__gte=from_day,
+                                              date__lte=to_day).order_by('date').values())
+
+        def pie_chart():
+            for federation in federations:
+                list(EntityStat.objects.filter(federation=federation,
+                                               feature__in=terms).order_by('-time')[0:len(terms)])
+
+        def last_stat():
+            for federation in federations:
+                EntityStat.objects.filter(federation=federation).aggregate(Max('time'))
+
+        return (
+            ('chart (EntityStat)', chart),
+            ('chart (DailyStat)', daily_chart),
+            ('pie chart', pie_chart),
+            ('last statistic', last_stat),
+        )
+
+    def _time_queries(self, queries, repeat):
+        return [(name, min(timeit.repeat(query, number=1, repeat=repeat)))
+                for name, query in queries]
+
+    def handle(self, *args, **options):
+        if args:
+            raise CommandError('benchmark_stats takes no arguments')
+
+        federations = []
+        for count in range(options['federations']):
+            federation, created = Federation.objects.get_or_create(
+                slug='%s%d' % (BENCHMARK_PREFIX, count),
+                defaults={'name': '%s%d' % (BENCHMARK_PREFIX, count)})
+            federations.append(federation)
+        if not EntityStat.objects.filter(federation__in=federations).exists():
+            self._seed(federations, options['years'])
+
+        try:
+            queries = self._queries(federations, options['days'])
+            results = [('with indexes', self._time_queries(queries, options['repeat']))]
+
+            if options['compare']:
+                index_together = EntityStat._meta.index_together
+                with connection.schema_editor() as schema_editor:
+                    schema_editor.alter_index_together(EntityStat, index_together, ())
+                try:
+                    results.append(('without indexes', self._time_queries(queries, options['repeat'])))
+                finally:
+                    with connection.schema_editor() as schema_editor:
+                        schema_editor.alter_index_together(EntityStat, (), index_together)
+        finally:
+            if not options['keep']:
+                for federation in federations:
+                    federation.delete()
+
+        self.stdout.write('Federations: %d, queries run once per federation' % len(federations))
+        for label, timings in results:
+            for name, timing in timings:
+                self.stdout.write('%-16s %-20s %8.1f ms total, %8.2f ms per federation' % (
+                    label, name, timing * 1e3, timing * 1e3 / len(federations)))
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+import met.metadataparser.models.base
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Dummy',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Entity',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('file_url', models.CharField(help_text='Url to fetch metadata file', max_length=1000, null=True, verbose_name=b'Metadata url', blank=True)),
+                ('file', models.FileField(help_text='if url is set, metadata url will be fetched and replace file value', upload_to=b'metadata', null=True, verbose_name='metadata xml file', blank=True)),
+                ('file_id', models.CharField(max_length=500, null=True, verbose_name='File ID', blank=True)),
+                ('registration_authority', models.CharField(max_length=200, null=True, verbose_name='Registration Authority', blank=True)),
+                ('entityid', models.CharField(unique=True, max_length=200, verbose_name='EntityID', db_index=True)),
+                ('name', met.metadataparser.models.base.JSONField(max_length=2000, null=True, verbose_name='Display Name', blank=True)),
+                ('certstats', models.CharField(max_length=200, null=True, verbose_name='Certificate Stats', blank=True)),
+                ('_display_protocols', models.CharField(max_length=300, null=True, verbose_name='Display Protocols', blank=True)),
+                ('editor_users', models.ManyToManyField(to=settings.AUTH_USER_MODEL, null=True, verbose_name='editor users', blank=True)),
+            ],
+            options={
+                'verbose_name': 'Entity',
+                'verbose_name_plural': 'Entities',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Entity_Federations',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('registration_instant', models.DateField(null=True, verbose_name='Registration Instant', blank=True)),
+                ('entity', models.ForeignKey(to='metadataparser.Entity')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='EntityCategory',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('category_id', models.CharField(help_text='The ID of the entity category', max_length=1000, verbose_name=b'Entity category ID')),
+                ('name', models.CharField(help_text='The name of the entity category', max_length=1000, null=True, verbose_name=b'Entity category name', blank=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='EntityStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('time', models.DateTimeField(verbose_name='Metadata time stamp')),
+                ('feature', models.CharField(max_length=100, verbose_name='Feature name', db_index=True)),
+                ('value', models.PositiveIntegerField(max_length=100, verbose_name='Feature value')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='EntityType',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('name', models.CharField(unique=True, max_length=20, verbose_name='Name', db_index=True)),
+                ('xmlname', models.CharField(unique=True, max_length=20, verbose_name='Name in XML', db_index=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.CreateModel(
+            name='Federation',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('file_url', models.CharField(help_text='Url to fetch metadata file', max_length=1000, null=True, verbose_name=b'Metadata url', blank=True)),
+                ('file', models.FileField(help_text='if url is set, metadata url will be fetched and replace file value', upload_to=b'metadata', null=True, verbose_name='metadata xml file', blank=True)),
+                ('file_id', models.CharField(max_length=500, null=True, verbose_name='File ID', blank=True)),
+                ('registration_authority', models.CharField(max_length=200, null=True, verbose_name='Registration Authority', blank=True)),
+                ('name', models.CharField(unique=True, max_length=200, verbose_name='Name')),
+                ('type', models.CharField(blank=True, max_length=100, null=True, verbose_name='Type', choices=[(None, b''), (b'hub-and-spoke', b'Hub and Spoke'), (b'mesh', b'Full Mesh')])),
+                ('url', models.URLField(null=True, verbose_name=b'Federation url', blank=True)),
+                ('fee_schedule_url', models.URLField(max_length=150, null=True, verbose_name=b'Fee schedule url', blank=True)),
+                ('logo', models.ImageField(upload_to=b'federation_logo', null=True, verbose_name='Federation logo', blank=True)),
+                ('is_interfederation', models.BooleanField(default=False, db_index=True, verbose_name='Is interfederation')),
+                ('slug', models.SlugField(unique=True, max_length=200)),
+                ('country', models.CharField(max_length=100, null=True, verbose_name='Country', blank=True)),
+                ('metadata_update', models.DateTimeField(null=True, verbose_name='Metadata update date and time', blank=True)),
+                ('certstats', models.CharField(max_length=200, null=True, verbose_name='Certificate Stats', blank=True)),
+                ('editor_users', models.ManyToManyField(to=settings.AUTH_USER_MODEL, null=True, verbose_name='editor users', blank=True)),
+            ],
+            options={
+                'abstract': False,
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='entitystat',
+            name='federation',
+            field=models.ForeignKey(verbose_name='Federations', to='metadataparser.Federation'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='entity_federations',
+            name='entity_categories',
+            field=models.ManyToManyField(to='metadataparser.EntityCategory', verbose_name='Entity categories'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='entity_federations',
+            name='federation',
+            field=models.ForeignKey(to='metadataparser.Federation'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='entity',
+            name='federations',
+            field=models.ManyToManyField(to='metadataparser.Federation', verbose_name='Federations', through='metadataparser.Entity_Federations'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='entity',
+            name='types',
+            field=models.ManyToManyField(to='metadataparser.EntityType', verbose_name='Type'),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metadataparser', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entity_federations',
+            name='fingerprint',
+            field=models.CharField(max_length=40, null=True, verbose_name='EntityDescriptor fingerprint', blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+import met.metadataparser.models.base
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metadataparser', '0002_entity_federations_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='entity',
+            name='file_validators',
+            field=met.metadataparser.models.base.JSONField(editable=False, max_length=5000, blank=True, help_text='ETag and Last-Modified of the metadata urls', null=True, verbose_name='Metadata url validators'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='federation',
+            name='file_validators',
+            field=met.metadataparser.models.base.JSONField(editable=False, max_length=5000, blank=True, help_text='ETag and Last-Modified of the metadata urls', null=True, verbose_name='Metadata url validators'),
+            preserve_default=True,
+        ),
+    ]
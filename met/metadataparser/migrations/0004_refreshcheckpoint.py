@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metadataparser', '0003_file_validators'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RefreshCheckpoint',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('run_started', models.DateTimeField(verbose_name='Refresh run start time')),
+                ('stage', models.CharField(default=b'pending', max_length=20, verbose_name='Refresh stage', choices=[(b'pending', 'Pending'), (b'fetch', 'Fetching metadata'), (b'federation', 'Updating federation'), (b'entities', 'Updating entities'), (b'stats', 'Computing statistics'), (b'done', 'Done'), (b'failed', 'Failed')])),
+                ('processed', models.PositiveIntegerField(default=0, verbose_name='Processed entities')),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='Entities to process')),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Last update time')),
+                ('federation', models.OneToOneField(related_name='refresh_checkpoint', verbose_name='Federation', to='metadataparser.Federation')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
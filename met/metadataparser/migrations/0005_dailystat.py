@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+FEATURES = ('sp', 'idp', 'aa', 'sp_saml1', 'sp_saml2', 'sp_shib1',
+            'idp_saml1', 'idp_saml2', 'idp_shib1')
+
+
+def copy_entity_stats(apps, schema_editor):
+    EntityStat = apps.get_model('metadataparser', 'EntityStat')
+    DailyStat = apps.get_model('metadataparser', 'DailyStat')
+
+    daily_stats = {}
+    entity_stats = EntityStat.objects.filter(feature__in=FEATURES).order_by('time')
+    for federation_id, feature, stat_time, value in entity_stats.values_list(
+            'federation_id', 'feature', 'time', 'value').iterator():
+        key = (federation_id, stat_time.date())
+        if key not in daily_stats:
+            daily_stats[key] = DailyStat(federation_id=federation_id, date=key[1])
+        setattr(daily_stats[key], feature, value)
+
+    DailyStat.objects.bulk_create(daily_stats.values(), batch_size=500)
+
+
+def delete_daily_stats(apps, schema_editor):
+    # The table is dropped by the reverse of CreateModel
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metadataparser', '0004_refreshcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStat',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('date', models.DateField(verbose_name='Statistics date')),
+                ('sp', models.PositiveIntegerField(default=0, verbose_name='SP')),
+                ('idp', models.PositiveIntegerField(default=0, verbose_name='IDP')),
+                ('aa', models.PositiveIntegerField(default=0, verbose_name='AA')),
+                ('sp_saml1', models.PositiveIntegerField(default=0, verbose_name='SP SAML 1.1')),
+                ('sp_saml2', models.PositiveIntegerField(default=0, verbose_name='SP SAML 2.0')),
+                ('sp_shib1', models.PositiveIntegerField(default=0, verbose_name='SP Shibboleth 1.0')),
+                ('idp_saml1', models.PositiveIntegerField(default=0, verbose_name='IDP SAML 1.1')),
+                ('idp_saml2', models.PositiveIntegerField(default=0, verbose_name='IDP SAML 2.0')),
+                ('idp_shib1', models.PositiveIntegerField(default=0, verbose_name='IDP Shibboleth 1.0')),
+                ('federation', models.ForeignKey(verbose_name='Federation', to='metadataparser.Federation')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailystat',
+            unique_together=set([('federation', 'date')]),
+        ),
+        migrations.RunPython(copy_entity_stats, delete_daily_stats),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metadataparser', '0005_dailystat'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='entitystat',
+            index_together=set([('federation', 'time'), ('federation', 'feature', 'time')]),
+        ),
+    ]
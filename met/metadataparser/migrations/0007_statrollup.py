@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from datetime import timedelta
+
+from django.db import models, migrations
+
+FEATURES = ('sp', 'idp', 'aa', 'sp_saml1', 'sp_saml2', 'sp_shib1',
+            'idp_saml1', 'idp_saml2', 'idp_shib1')
+
+PERIOD_START = {
+    'week': lambda day: day - timedelta(days=day.weekday()),
+    'month': lambda day: day.replace(day=1),
+    'year': lambda day: day.replace(month=1, day=1),
+}
+
+
+def create_rollups(apps, schema_editor):
+    DailyStat = apps.get_model('metadataparser', 'DailyStat')
+    StatRollup = apps.get_model('metadataparser', 'StatRollup')
+
+    # Every period keeps the values of its last day
+    rollups = {}
+    for daily_stat in DailyStat.objects.order_by('date').iterator():
+        for resolution, period_start in PERIOD_START.items():
+            key = (daily_stat.federation_id, resolution, period_start(daily_stat.date))
+            rollup = StatRollup(federation_id=key[0], resolution=resolution, date=key[2])
+            for feature in FEATURES:
+                setattr(rollup, feature, getattr(daily_stat, feature))
+            rollups[key] = rollup
+
+    StatRollup.objects.bulk_create(rollups.values(), batch_size=500)
+
+
+def delete_rollups(apps, schema_editor):
+    # The table is dropped by the reverse of CreateModel
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metadataparser', '0006_entitystat_index_together'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatRollup',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('sp', models.PositiveIntegerField(default=0, verbose_name='SP')),
+                ('idp', models.PositiveIntegerField(default=0, verbose_name='IDP')),
+                ('aa', models.PositiveIntegerField(default=0, verbose_name='AA')),
+                ('sp_saml1', models.PositiveIntegerField(default=0, verbose_name='SP SAML 1.1')),
+                ('sp_saml2', models.PositiveIntegerField(default=0, verbose_name='SP SAML 2.0')),
+                ('sp_shib1', models.PositiveIntegerField(default=0, verbose_name='SP Shibboleth 1.0')),
+                ('idp_saml1', models.PositiveIntegerField(default=0, verbose_name='IDP SAML 1.1')),
+                ('idp_saml2', models.PositiveIntegerField(default=0, verbose_name='IDP SAML 2.0')),
+                ('idp_shib1', models.PositiveIntegerField(default=0, verbose_name='IDP Shibboleth 1.0')),
+                ('resolution', models.CharField(max_length=10, verbose_name='Period length', choices=[(b'week', 'Week'), (b'month', 'Month'), (b'year', 'Year')])),
+                ('date', models.DateField(verbose_name='Period start date')),
+                ('federation', models.ForeignKey(verbose_name='Federation', to='metadataparser.Federation')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='statrollup',
+            unique_together=set([('federation', 'resolution', 'date')]),
+        ),
+        migrations.RunPython(create_rollups, delete_rollups),
+    ]
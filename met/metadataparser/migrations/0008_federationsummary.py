@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.db.models import Count
+import met.metadataparser.models.base
+
+
+def create_summaries(apps, schema_editor):
+    Entity = apps.get_model('metadataparser', 'Entity')
+    FederationSummary = apps.get_model('metadataparser', 'FederationSummary')
+
+    summaries = {None: FederationSummary(total=Entity.objects.count(), types={})}
+    for count in Entity.objects.values('federations__id').annotate(Count('federations__id')):
+        if count['federations__id'] is not None:
+            summaries[count['federations__id']] = FederationSummary(
+                federation_id=count['federations__id'], total=count['federations__id__count'],
+                types={})
+
+    type_counts = Entity.objects.values('federations__id', 'types__xmlname').annotate(
+        Count('types__xmlname'))
+    for count in type_counts:
+        if count['federations__id'] is not None and count['types__xmlname'] is not None:
+            summaries[count['federations__id']].types[count['types__xmlname']] = \
+                count['types__xmlname__count']
+
+    for count in Entity.objects.values('types__xmlname').annotate(Count('types__xmlname')):
+        if count['types__xmlname'] is not None:
+            summaries[None].types[count['types__xmlname']] = count['types__xmlname__count']
+
+    FederationSummary.objects.bulk_create(summaries.values())
+
+
+def delete_summaries(apps, schema_editor):
+    # The table is dropped by the reverse of CreateModel
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('metadataparser', '0007_statrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FederationSummary',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('total', models.PositiveIntegerField(default=0, verbose_name='Entities')),
+                ('types', met.metadataparser.models.base.JSONField(verbose_name='Entities by type', max_length=5000, null=True, editable=False, blank=True)),
+                ('updated', models.DateTimeField(auto_now=True, verbose_name='Last update time')),
+                ('federation', models.OneToOneField(related_name='summary', null=True, blank=True, to='metadataparser.Federation', verbose_name='Federation')),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.RunPython(create_summaries, delete_summaries),
+    ]
@@ -19,6 +19,9 @@ from entity_type import EntityType
 from entity_category import EntityCategory
 from entity_federations import Entity_Federations
 from entity_stat import EntityStat
+from daily_stat import DailyStat, StatRollup
+from refresh_checkpoint import RefreshCheckpoint
+from federation_summary import FederationSummary
 
 TOP_LENGTH = getattr(settings, "TOP_LENGTH", 5)
 
@@ -30,4 +33,8 @@ __all__ = ['TOP_LENGTH',
            'Entity',
            'Entity_Federations',
            'EntityStat',
+           'DailyStat',
+           'StatRollup',
+           'RefreshCheckpoint',
+           'FederationSummary',
            'Dummy']
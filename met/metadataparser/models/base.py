@@ -10,21 +10,97 @@
 # Consortium GARR, http://www.garr.it
 ##########################################################################
 
+import os
+import errno
+import hashlib
+import shutil
+import tempfile
 from os import path
 from lxml import etree
+import requests
 import simplejson as json
 
-from django.db import models
+from django.conf import settings
+from django.db import models, connection
 from django.contrib.auth.models import User
 from django.core import validators
-from django.core.files.base import ContentFile
 from django.utils.translation import ugettext_lazy as _
 
 from pyff.mdrepo import MDRepository
 from pyff.pipes import Plumbing
 
-from met.metadataparser.xmlparser import MetadataParser
-from met.metadataparser.utils import compare_filecontents
+from met.metadataparser.xmlparser import MetadataParser, EntityCache
+from met.metadataparser.utils import DigestWriter
+
+FETCH_TIMEOUT = 120
+FETCH_CHUNK_SIZE = 64 * 1024
+
+ENTITY_CACHES = {}
+
+
+def get_entity_cache():
+    """
+    Returns the cache of parsed entities stored in the ENTITY_CACHE_FILE
+    setting, read when the cache is used.
+    """
+    filename = getattr(settings, 'ENTITY_CACHE_FILE', None)
+    return ENTITY_CACHES.setdefault(filename, EntityCache(filename))
+
+
+def _new_storage_file(storage, directory):
+    """
+    Creates a new hidden file in directory with the permissions of the
+    files saved by storage, while tempfile would make it readable only
+    by its owner. Returns the open file and its name.
+    """
+    while True:
+        name = path.join(directory, '.%s.tmp' % os.urandom(8).encode('hex'))
+        try:
+            fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+            break
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    permissions = getattr(storage, 'file_permissions_mode', None)
+    if permissions is not None:
+        os.chmod(name, permissions)
+    return os.fdopen(fd, 'wb'), name
+
+
+def bulk_update(objects, fields, batch_size=500):
+    """
+    Saves the given fields of many objects of the same model with a single
+    UPDATE statement per batch, the value of each row being selected by a
+    CASE on its primary key.
+    """
+    if not objects:
+        return
+
+    model = objects[0].__class__
+    qn = connection.ops.quote_name
+    pk_column = qn(model._meta.pk.column)
+    db_fields = [model._meta.get_field(name) for name in fields]
+    batch_size = max(1, min(batch_size, connection.ops.bulk_batch_size(
+        db_fields * 2 + [model._meta.pk], objects)))
+
+    cursor = connection.cursor()
+    for start in range(0, len(objects), batch_size):
+        batch = objects[start:start + batch_size]
+        assignments = []
+        params = []
+        for field in db_fields:
+            cases = []
+            for obj in batch:
+                cases.append('WHEN %s THEN %s')
+                params.extend([obj.pk, field.get_db_prep_save(getattr(obj, field.attname), connection)])
+            assignments.append('%s = CASE %s %s ELSE %s END' % (
+                qn(field.column), pk_column, ' '.join(cases), qn(field.column)))
+        params.extend([obj.pk for obj in batch])
+
+        cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+            qn(model._meta.db_table), ', '.join(assignments), pk_column,
+            ', '.join(['%s'] * len(batch))), params)
 
 
 class JSONField(models.CharField):
@@ -103,6 +179,9 @@ class Base(models.Model):
                                         "fetched and replace file value"))
     file_id = models.CharField(blank=True, null=True, max_length=500,
                                verbose_name=_(u'File ID'))
+    file_validators = JSONField(blank=True, null=True, max_length=5000, editable=False,
+                                verbose_name=_(u'Metadata url validators'),
+                                help_text=_(u'ETag and Last-Modified of the metadata urls'))
 
     registration_authority = models.CharField(verbose_name=_('Registration Authority'),
                                               max_length=200, blank=True, null=True)
@@ -124,10 +203,14 @@ class Base(models.Model):
             # Only load file and parse it, don't create/update any objects
             if not self.file:
                 return None
-            self._loaded_file = MetadataParser(filename=self.file.path)
+            self._loaded_file = MetadataParser(filename=self.file.path, entity_cache=get_entity_cache())
         return self._loaded_file
 
-    def _get_metadata_stream(self, load_streams):
+    def _write_metadata_stream(self, load_streams, output):
+        """
+        Runs the pyFF pipeline and serializes its result incrementally
+        into output.
+        """
         try:
             load = []
             select = []
@@ -151,11 +234,110 @@ class Base(models.Model):
             md = MDRepository()
             entities = Plumbing(pipeline=pipeline, id=self.slug).process(
                 md, state={'batch': True, 'stats': {}})
-            return etree.tostring(entities)
+            with etree.xmlfile(output) as xml_file:
+                xml_file.write(entities)
         except Exception, e:
             raise Exception(
                 'Getting metadata from %s failed.\nError: %s' % (load_streams, e))
 
+    @staticmethod
+    def _conditional_get(url, validators):
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        response = requests.get(url, headers=headers, stream=True, timeout=FETCH_TIMEOUT)
+        response.raise_for_status()
+        return response
+
+    def _source_copy(self, url):
+        """
+        Returns the path of the local copy kept for the metadata url in the
+        METADATA_SOURCES_DIR setting, or None when copies are not kept.
+        """
+        sources_dir = getattr(settings, 'METADATA_SOURCES_DIR', None)
+        if not sources_dir:
+            return None
+        return path.join(sources_dir, '%s-%s.xml' % (self.slug, hashlib.sha1(url.encode('utf-8')).hexdigest()))
+
+    @staticmethod
+    def _keep_source_copies(downloads):
+        for filename, copy in downloads:
+            if copy is None:
+                continue
+            if not path.exists(path.dirname(copy)):
+                os.makedirs(path.dirname(copy))
+            shutil.move(filename, copy)
+
+    def _fetch_metadata_sources(self, metadata_files, download_dir):
+        """
+        Sends conditional requests for the remote metadata urls.
+        Modified sources are downloaded in download_dir and not modified
+        ones are read from their kept copy, both replacing the url in the
+        pyFF pipeline.
+        Returns the sources to be loaded, the new validators, whether any
+        source has been modified and the downloaded files with the path of
+        their copy.
+        """
+        validators = self.file_validators or {}
+        if not self.file or not path.exists(self.file.path):
+            validators = {}
+
+        sources = []
+        new_validators = {}
+        downloads = []
+        modified = False
+        for count, source in enumerate(metadata_files):
+            url = source[0].strip()
+            if not url.startswith('http://') and not url.startswith('https://'):
+                sources.append(source)
+                modified = True
+                continue
+
+            copy = self._source_copy(url)
+            url_validators = validators.get(url, {})
+            if copy is None or not path.exists(copy):
+                # Without the local copy the source must be downloaded again
+                url_validators = {}
+
+            try:
+                response = self._conditional_get(url, url_validators)
+            except Exception:
+                # Let pyFF fetch the url and report the error
+                sources.append(source)
+                modified = True
+                continue
+
+            try:
+                if response.status_code == 304 and url_validators:
+                    sources.append([copy] + source[1:])
+                    new_validators[url] = url_validators
+                    continue
+
+                filename = path.join(download_dir, 'source%d.xml' % count)
+                with open(filename, 'wb') as local_file:
+                    for chunk in response.iter_content(FETCH_CHUNK_SIZE):
+                        local_file.write(chunk)
+            finally:
+                response.close()
+
+            sources.append([filename] + source[1:])
+            downloads.append((filename, copy))
+            modified = True
+            current = {'etag': response.headers.get('ETag'),
+                       'last_modified': response.headers.get('Last-Modified')}
+            if current['etag'] or current['last_modified']:
+                new_validators[url] = current
+
+        return sources, new_validators, modified, downloads
+
+    def _save_file_validators(self, file_validators):
+        self.file_validators = file_validators
+        if self.pk:
+            type(self).objects.filter(pk=self.pk).update(file_validators=file_validators)
+
     def fetch_metadata_file(self, file_name):
         file_url = self.file_url
         if not file_url or file_url == '':
@@ -169,21 +351,56 @@ class Base(models.Model):
                 cursource.append("All")
             metadata_files.append(cursource)
 
-        req = self._get_metadata_stream(metadata_files)
+        filename = self.file.field.generate_filename(self, "%s-metadata.xml" % file_name)
+        file_path = self.file.storage.path(filename)
+        if not path.exists(path.dirname(file_path)):
+            os.makedirs(path.dirname(file_path))
 
+        download_dir = tempfile.mkdtemp()
+        new_file, new_file_name = _new_storage_file(self.file.storage, path.dirname(file_path))
         try:
-            self.file.seek(0)
-            original_file_content = self.file.read()
-            if compare_filecontents(original_file_content, req):
+            sources, file_validators, modified, downloads = self._fetch_metadata_sources(
+                metadata_files, download_dir)
+            if not modified:
                 return False
-        except Exception:
-            pass
 
-        filename = path.basename("%s-metadata.xml" % file_name)
-        self.file.delete(save=False)
-        self.file.save(filename, ContentFile(req), save=False)
+            output = DigestWriter(new_file)
+            self._write_metadata_stream(sources, output)
+            new_file.close()
+
+            # The validators are stored only with the copies they refer to
+            self._keep_source_copies(downloads)
+            if output.hexdigest() == self._stored_file_digest():
+                self._save_file_validators(file_validators)
+                return False
+
+            # The stored file is replaced only when the new one is complete
+            os.rename(new_file_name, file_path)
+        finally:
+            new_file.close()
+            if path.exists(new_file_name):
+                os.unlink(new_file_name)
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+        if self.file and self.file.name != filename:
+            self.file.delete(save=False)
+        self.file = filename
+        if hasattr(self, '_loaded_file'):
+            del self._loaded_file
+
+        # Saved by the caller together with the new file
+        self.file_validators = file_validators
         return True
 
+    def _stored_file_digest(self):
+        if not self.file:
+            return None
+
+        try:
+            return MetadataParser(filename=self.file.path).file_digest()
+        except Exception:
+            return None
+
     @classmethod
     def process_metadata(cls):
         """
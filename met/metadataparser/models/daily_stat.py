@@ -0,0 +1,116 @@
+##########################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+##########################################################################
+
+from datetime import timedelta
+
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+ROLLUP_RESOLUTIONS = (
+    ('week', _(u'Week')),
+    ('month', _(u'Month')),
+    ('year', _(u'Year')),
+)
+
+
+def period_start(day, resolution):
+    """
+    Returns the first day of the week, month or year of day.
+    """
+    if resolution == 'week':
+        return day - timedelta(days=day.weekday())
+    if resolution == 'month':
+        return day.replace(day=1)
+    if resolution == 'year':
+        return day.replace(month=1, day=1)
+    return day
+
+
+def period_count(from_date, to_date, resolution):
+    """
+    Returns the number of weeks, months or years including the days
+    from from_date to to_date.
+    """
+    if resolution == 'week':
+        return (to_date - period_start(from_date, 'week')).days // 7 + 1
+    if resolution == 'month':
+        return (to_date.year - from_date.year) * 12 + to_date.month - from_date.month + 1
+    if resolution == 'year':
+        return to_date.year - from_date.year + 1
+    return (to_date - from_date).days + 1
+
+
+class FeatureStats(models.Model):
+    """
+    Value of every statistics feature, one column each.
+    """
+
+    FEATURES = ('sp', 'idp', 'aa', 'sp_saml1', 'sp_saml2', 'sp_shib1',
+                'idp_saml1', 'idp_saml2', 'idp_shib1')
+
+    sp = models.PositiveIntegerField(default=0, verbose_name=_(u'SP'))
+    idp = models.PositiveIntegerField(default=0, verbose_name=_(u'IDP'))
+    aa = models.PositiveIntegerField(default=0, verbose_name=_(u'AA'))
+    sp_saml1 = models.PositiveIntegerField(default=0, verbose_name=_(u'SP SAML 1.1'))
+    sp_saml2 = models.PositiveIntegerField(default=0, verbose_name=_(u'SP SAML 2.0'))
+    sp_shib1 = models.PositiveIntegerField(default=0, verbose_name=_(u'SP Shibboleth 1.0'))
+    idp_saml1 = models.PositiveIntegerField(default=0, verbose_name=_(u'IDP SAML 1.1'))
+    idp_saml2 = models.PositiveIntegerField(default=0, verbose_name=_(u'IDP SAML 2.0'))
+    idp_shib1 = models.PositiveIntegerField(default=0, verbose_name=_(u'IDP Shibboleth 1.0'))
+
+    class Meta(object):
+        abstract = True
+
+    def copy_features(self, other):
+        for feature in self.FEATURES:
+            setattr(self, feature, getattr(other, feature))
+
+
+class DailyStat(FeatureStats):
+    """
+    Statistics of a federation for a day.
+    """
+
+    federation = models.ForeignKey('Federation', blank=False,
+                                   verbose_name=_(u'Federation'))
+
+    date = models.DateField(blank=False, null=False,
+                            verbose_name=_(u'Statistics date'))
+
+    class Meta(object):
+        unique_together = (('federation', 'date'),)
+
+    def __unicode__(self):
+        return u'%s %s' % (self.federation_id, self.date)
+
+
+class StatRollup(FeatureStats):
+    """
+    Statistics of a federation for a week, month or year: the values of
+    the last day of the period with statistics.
+    """
+
+    federation = models.ForeignKey('Federation', blank=False,
+                                   verbose_name=_(u'Federation'))
+
+    resolution = models.CharField(max_length=10, choices=ROLLUP_RESOLUTIONS,
+                                  verbose_name=_(u'Period length'))
+
+    date = models.DateField(blank=False, null=False,
+                            verbose_name=_(u'Period start date'))
+
+    class Meta(object):
+        unique_together = (('federation', 'resolution', 'date'),)
+
+    def __unicode__(self):
+        return u'%s %s %s' % (self.federation_id, self.resolution, self.date)
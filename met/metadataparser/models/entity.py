@@ -388,17 +388,27 @@ class Entity(Base):
         if not entity_data:
             self.load_metadata()
 
-        if self.entityid.lower() != entity_data.get('entityid').lower():
-            raise ValueError("EntityID is not the same: %s != %s" % (
-                self.entityid.lower(), entity_data.get('entityid').lower()))
-
-        self._entity_cached = entity_data
+        self.update_from_metadata(entity_data)
 
         if self.xml_types:
             entity_types = self._get_or_create_etypes(cached_entity_types)
             if len(entity_types) > 0:
                 self.types.add(*entity_types)
 
+        if auto_save:
+            self.save()
+
+    def update_from_metadata(self, entity_data):
+        """
+        Sets the entity fields from its parsed metadata, without saving
+        the entity nor touching its relations.
+        """
+        if self.entityid.lower() != entity_data.get('entityid').lower():
+            raise ValueError("EntityID is not the same: %s != %s" % (
+                self.entityid.lower(), entity_data.get('entityid').lower()))
+
+        self._entity_cached = entity_data
+
         newname = self._get_property('displayName')
         if newname and newname != '':
             self.name = newname
@@ -413,9 +423,6 @@ class Entity(Base):
             self.registration_authority = self._get_property(
                 'registration_authority')
 
-        if auto_save:
-            self.save()
-
     def to_dict(self):
         self.load_metadata()
 
@@ -29,6 +29,9 @@ class Entity_Federations(models.Model):
     entity_categories = models.ManyToManyField('EntityCategory',
                                                verbose_name=_(u'Entity categories'))
 
+    fingerprint = models.CharField(blank=True, null=True, max_length=40,
+                                   verbose_name=_(u'EntityDescriptor fingerprint'))
+
     def __unicode__(self):
         cats = [ c.name for c in self.entity_categories.all() ]
         return "%s in federation %s %s" % (self.entity.entityid, self.federation.slug, cats)
@@ -34,5 +34,10 @@ class EntityStat(models.Model):
     federation = models.ForeignKey('Federation', blank=False,
                                    verbose_name=_(u'Federations'))
 
+    class Meta(object):
+        # Statistics are read by federation and time range, also per feature
+        index_together = (('federation', 'feature', 'time'),
+                          ('federation', 'time'))
+
     def __unicode__(self):
         return self.feature
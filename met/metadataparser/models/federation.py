@@ -11,27 +11,32 @@
 ##########################################################################
 
 import pytz
+import threading
+import numpy as np
 import simplejson as json
+from collections import OrderedDict
 
 from datetime import datetime, time, timedelta
 
+from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
 from django.db.models import Max
-from django.db.models.signals import pre_save
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from django.utils import timezone
 from django.dispatch import receiver
 from django.template.defaultfilters import slugify
 
-from met.metadataparser.xmlparser import MetadataParser
-
-from met.metadataparser.models.base import Base, XmlDescriptionError
+from met.metadataparser.xmlparser import DESCRIPTOR_TYPES_DISPLAY
+from met.metadataparser.models.base import Base, XmlDescriptionError, bulk_update
 from met.metadataparser.models.entity import Entity
 from met.metadataparser.models.entity_type import EntityType
 from met.metadataparser.models.entity_stat import EntityStat, stats
+from met.metadataparser.models.daily_stat import DailyStat, StatRollup, ROLLUP_RESOLUTIONS, period_start
 from met.metadataparser.models.entity_category import EntityCategory
 from met.metadataparser.models.entity_federations import Entity_Federations
+from met.metadataparser.models.federation_summary import FederationSummary
 
 FEDERATION_TYPES = (
     (None, ''),
@@ -39,6 +44,18 @@ FEDERATION_TYPES = (
     ('mesh', 'Full Mesh'),
 )
 
+# Entities processed between two updates of the refresh progress
+PROGRESS_STEP = 100
+
+# Serializes the writes of concurrent refreshes to the rows shared by the
+# federations: entity types and categories, and the entities themselves
+SHARED_ROWS_LOCK = threading.Lock()
+
+
+def _entity_batch_size():
+    """Entities committed together when the entities of a federation are updated"""
+    return getattr(settings, 'REFRESH_ENTITY_BATCH_SIZE', 1000)
+
 
 def update_obj(mobj, obj, attrs=None):
     for_attrs = attrs or getattr(mobj, 'all_attrs', [])
@@ -102,6 +119,10 @@ class Federation(Base):
     def get_entity(self, entityid):
         return self.entity_set.get(entityid=entityid)
 
+    def update_metadata_index(self):
+        if self._metadata and not self._metadata.has_index():
+            self._metadata.build_index()
+
     def process_metadata(self):
         metadata = self.load_file()
 
@@ -116,116 +137,256 @@ class Federation(Base):
             raise XmlDescriptionError("XML Haven't federation form")
 
         update_obj(metadata.get_federation(), self)
-        self.certstats = MetadataParser.get_certstats(metadata.rootelem)
+        self.certstats = metadata.get_file_certstats()
 
     def _remove_deleted_entities(self, entities_from_xml):
-        removed = 0
-        for entity in self.entity_set.all():
-            # Remove entity relation if does not exist in metadata
-            if not entity.entityid in entities_from_xml:
-                Entity_Federations.objects.filter(
-                    federation=self, entity=entity).delete()
-                removed += 1
-
-        return removed
-
-    def _get_or_create_ecategories(self, entity, cached_entity_categories):
-        entity_categories = []
-        efed = Entity_Federations.objects.get_or_create(federation=self, entity=entity)[0]
-        cur_cached_categories = [
-            t.category_id for t in efed.entity_categories.all()]
-        for ecategory in entity.xml_categories:
-            if ecategory in cur_cached_categories:
-                break
-
-            if cached_entity_categories is None:
-                entity_category, _ = EntityCategory.objects.get_or_create(
-                    category_id=ecategory)
-            else:
-                if ecategory in cached_entity_categories:
-                    entity_category = cached_entity_categories[ecategory]
-                else:
-                    entity_category = EntityCategory.objects.create(
-                        category_id=ecategory)
-            entity_categories.append(entity_category)
-        return entity_categories
-
-    def _update_entities(self, entities_to_update, entities_to_add):
-        for e in entities_to_update:
-            e.save()
-
-        for e in entities_to_add:
-            membership = Entity_Federations.objects.get_or_create(federation=self, entity=e)[0]
-            membership.registration_instant = e.registration_instant.date() if e.registration_instant else None
-
-            if e.xml_categories:
-                db_entity_categories = EntityCategory.objects.all()
-                cached_entity_categories = {
-                    entity_category.category_id: entity_category for entity_category in db_entity_categories}
-
-                # Delete categories no more present in XML
-                membership.entity_categories.clear()
-
-                # Create all entities, if not alread in database
-                entity_categories = self._get_or_create_ecategories(e, cached_entity_categories)
-
-                # Add categories to entity
-                if len(entity_categories) > 0:
-                    membership.entity_categories.add(*entity_categories)
-            else:
-                # No categories in XML, delete eventual categorie sin DB
-                membership.entity_categories.clear()
+        entities_from_xml = frozenset(entities_from_xml)
+        memberships = Entity_Federations.objects.filter(federation=self)
+
+        # Remove entity relations that do not exist in metadata anymore
+        removed_entities = set()
+        removed_ids = []
+        for membership_id, entityid in memberships.values_list('id', 'entity__entityid'):
+            if entityid not in entities_from_xml:
+                removed_entities.add(entityid)
+                removed_ids.append(membership_id)
+
+        # The entity categories links of the memberships are deleted with them
+        batch_size = connection.ops.bulk_batch_size(['id'], removed_ids) or 1
+        for start in range(0, len(removed_ids), batch_size):
+            Entity_Federations.objects.filter(pk__in=removed_ids[start:start + batch_size]).delete()
+
+        return len(removed_entities)
+
+    def _report_progress(self, request, federation_slug, count, force=False):
+        if request and federation_slug and (force or count % PROGRESS_STEP == 0):
+            request.session['%s_cur_entities' % federation_slug] = count
+            request.session.save()
 
-            membership.save()
+    @staticmethod
+    def _create_entity_type(etype):
+        try:
+            with transaction.atomic():
+                return EntityType.objects.create(xmlname=etype, name=DESCRIPTOR_TYPES_DISPLAY[etype])
+        except IntegrityError:
+            # Created in the meantime by a concurrent refresh
+            return EntityType.objects.get(xmlname=etype)
+
+    def _get_entity_types(self, entities_from_xml):
+        entity_types = dict((entity_type.xmlname, entity_type)
+                            for entity_type in EntityType.objects.all())
+        for entity_from_xml in entities_from_xml:
+            for etype in entity_from_xml.get('entity_types') or ():
+                if etype not in entity_types:
+                    entity_types[etype] = self._create_entity_type(etype)
+        return entity_types
+
+    def _add_entity_types(self, entities, entities_from_xml, new_entity_ids, entity_types):
+        EntityTypes = Entity.types.through
+        type_links = []
+        for entity_from_xml in entities_from_xml:
+            entity = entities[entity_from_xml['entityid']]
+            # Types are prefetched for the entities already in the database
+            cur_types = set()
+            if entity.pk not in new_entity_ids:
+                cur_types = set(etype.xmlname for etype in entity.types.all())
+            for etype in set(entity_from_xml.get('entity_types') or ()) - cur_types:
+                type_links.append(EntityTypes(entity_id=entity.pk,
+                                              entitytype_id=entity_types[etype].pk))
+        EntityTypes.objects.bulk_create(type_links)
+
+    def _get_entity_categories(self, entities_from_xml):
+        entity_categories = dict((entity_category.category_id, entity_category)
+                                 for entity_category in EntityCategory.objects.all())
+        missing = set()
+        for entity_from_xml in entities_from_xml:
+            missing.update(entity_from_xml.get('entity_categories') or ())
+        missing -= set(entity_categories.keys())
+
+        if missing:
+            EntityCategory.objects.bulk_create(
+                [EntityCategory(category_id=category_id) for category_id in missing])
+            for entity_category in EntityCategory.objects.filter(category_id__in=missing):
+                entity_categories[entity_category.category_id] = entity_category
+        return entity_categories
 
-    def _add_new_entities(self, entities, entities_from_xml, request, federation_slug):
-        db_entity_types = EntityType.objects.all()
-        cached_entity_types = {
-            entity_type.xmlname: entity_type for entity_type in db_entity_types}
+    def _get_memberships(self):
+        memberships = {}
+        for membership in Entity_Federations.objects.filter(federation=self).select_related('entity'):
+            memberships[membership.entity.entityid] = membership
+        return memberships
+
+    def _update_memberships(self, entities, entities_from_xml, memberships, entity_categories):
+        memberships_to_add = []
+        memberships_to_update = []
+        for entity_from_xml in entities_from_xml:
+            entity = entities[entity_from_xml['entityid']]
+            reginstant = entity.registration_instant.date() if entity.registration_instant else None
+
+            membership = memberships.get(entity.entityid)
+            if membership is None:
+                membership = Entity_Federations(federation=self, entity_id=entity.pk,
+                                                registration_instant=reginstant,
+                                                fingerprint=entity_from_xml.fingerprint)
+                memberships[entity.entityid] = membership
+                memberships_to_add.append(membership)
+            elif membership.pk:
+                membership.registration_instant = reginstant
+                membership.fingerprint = entity_from_xml.fingerprint
+                memberships_to_update.append(membership)
+
+        Entity_Federations.objects.bulk_create(memberships_to_add)
+        if memberships_to_add:
+            added = dict((m.entity_id, m) for m in memberships_to_add)
+            new_ids = Entity_Federations.objects.filter(federation=self, entity_id__in=added.keys())
+            for entity_id, membership_id in new_ids.values_list('entity_id', 'id'):
+                added[entity_id].pk = membership_id
+        bulk_update(memberships_to_update, ['registration_instant', 'fingerprint'])
+
+        self._update_entity_categories(entities_from_xml, memberships,
+                                       memberships_to_update, entity_categories)
+
+        return len(memberships_to_add), len(memberships_to_update)
 
+    @staticmethod
+    def _update_entity_categories(entities_from_xml, memberships, memberships_to_update,
+                                  entity_categories):
+        EntityCategories = Entity_Federations.entity_categories.through
+        desired = set()
+        for entity_from_xml in entities_from_xml:
+            membership = memberships[entity_from_xml['entityid']]
+            for category_id in entity_from_xml.get('entity_categories') or ():
+                desired.add((membership.pk, entity_categories[category_id].pk))
+
+        # Only the links of the updated memberships can be already there
+        current = {}
+        updated_ids = [m.pk for m in memberships_to_update]
+        batch_size = connection.ops.bulk_batch_size(['id'], updated_ids) or 1
+        for start in range(0, len(updated_ids), batch_size):
+            links = EntityCategories.objects.filter(
+                entity_federations__in=updated_ids[start:start + batch_size])
+            for link_id, membership_id, category_id in links.values_list(
+                    'id', 'entity_federations_id', 'entitycategory_id'):
+                current[(membership_id, category_id)] = link_id
+
+        removed_ids = [link_id for pair, link_id in current.iteritems() if pair not in desired]
+        batch_size = connection.ops.bulk_batch_size(['id'], removed_ids) or 1
+        for start in range(0, len(removed_ids), batch_size):
+            EntityCategories.objects.filter(pk__in=removed_ids[start:start + batch_size]).delete()
+
+        EntityCategories.objects.bulk_create(
+            [EntityCategories(entity_federations_id=membership_id, entitycategory_id=category_id)
+             for membership_id, category_id in desired if (membership_id, category_id) not in current])
+
+    def _add_new_entities(self, entities, entities_from_xml, memberships, shared_rows,
+                          request, federation_slug, start=0):
         entities_to_add = []
         entities_to_update = []
 
-        for m_id in entities_from_xml:
-            if request and federation_slug:
-                request.session['%s_cur_entities' % federation_slug] += 1
-                request.session.save()
-
-            created = False
+        for count, entity_from_xml in enumerate(entities_from_xml, start + 1):
+            m_id = entity_from_xml['entityid']
             if m_id in entities:
                 entity = entities[m_id]
-            else:
-                entity, created = Entity.objects.get_or_create(entityid=m_id)
-
-            entityid = entity.entityid
-            name = entity.name
-            registration_authority = entity.registration_authority
-            certstats = entity.certstats
-            display_protocols = entity._display_protocols
-
-            entity_from_xml = self._metadata.get_entity(m_id, False)
-            entity.process_metadata(False, entity_from_xml, cached_entity_types, self)
+                entityid = entity.entityid
+                name = entity.name
+                registration_authority = entity.registration_authority
+                certstats = entity.certstats
+                display_protocols = entity._display_protocols
 
-            if created or entity.has_changed(entityid, name, registration_authority, certstats, display_protocols):
-                entities_to_update.append(entity)
+                entity.update_from_metadata(entity_from_xml)
 
-            entities_to_add.append(entity)
-
-        self._update_entities(entities_to_update, entities_to_add)
-        return len(entities_to_update)
+                if entity.pk and entity.has_changed(entityid, name, registration_authority,
+                                                    certstats, display_protocols):
+                    entities_to_update.append(entity)
+            else:
+                entity = Entity(entityid=m_id)
+                entity.update_from_metadata(entity_from_xml)
+                entities[m_id] = entity
+                entities_to_add.append(entity)
+
+            self._report_progress(request, federation_slug, count)
+
+        Entity.objects.bulk_create(entities_to_add)
+        new_entity_ids = set()
+        if entities_to_add:
+            new_ids = Entity.objects.filter(entityid__in=[e.entityid for e in entities_to_add])
+            for entityid, entity_id in new_ids.values_list('entityid', 'id'):
+                entities[entityid].pk = entity_id
+                new_entity_ids.add(entity_id)
+        bulk_update(entities_to_update, ['name', 'registration_authority',
+                                     'certstats', '_display_protocols'])
+
+        entity_types, entity_categories = shared_rows
+        self._add_entity_types(entities, entities_from_xml, new_entity_ids, entity_types)
+        added, modified = self._update_memberships(entities, entities_from_xml, memberships,
+                                                   entity_categories)
+
+        return added, modified
 
     @staticmethod
     def _daterange(start_date, end_date):
         for n in range(int((end_date - start_date).days + 1)):
             yield start_date + timedelta(n)
 
+    def _get_stat_entities(self):
+        """
+        Loads the registration day in this federation, the protocols and the
+        types of the entities of the metadata file into NumPy arrays.
+        """
+        entities_from_xml = self._metadata.get_entity_id_set()
+
+        entity_index = {}
+        registered = []
+        protocols = []
+        memberships = Entity_Federations.objects.filter(federation=self)
+        for entity_id, entityid, reginstant, display_protocols in memberships.values_list(
+                'entity_id', 'entity__entityid', 'registration_instant', 'entity___display_protocols'):
+            if entityid not in entities_from_xml:
+                continue
+            entity_index[entity_id] = len(registered)
+            registered.append(reginstant.toordinal() if reginstant else np.nan)
+            protocols.append(display_protocols or '')
+
+        types = {}
+        entity_types = Entity.types.through.objects.filter(entity__entity_federations__federation=self)
+        for entity_id, xmlname in entity_types.values_list('entity_id', 'entitytype__xmlname'):
+            if entity_id in entity_index:
+                if xmlname not in types:
+                    types[xmlname] = np.zeros(len(registered), dtype=bool)
+                types[xmlname][entity_index[entity_id]] = True
+
+        return np.array(registered, dtype=float), protocols, types
+
+    @staticmethod
+    def _get_stat_filter(feature):
+        """
+        Returns the entity type and the protocol counted by a feature.
+        """
+        if feature in ('sp', 'idp', 'aa'):
+            return stats['features'][feature], None
+        return stats['features'][feature.split('_')[0]], stats['features'][feature]
+
+    def _update_stat_rollups(self, daily_stats):
+        """
+        Replaces the rollups of the periods including the new daily
+        statistics, which are the most recent ones.
+        """
+        for resolution, label in ROLLUP_RESOLUTIONS:
+            rollups = OrderedDict()
+            for daily_stat in sorted(daily_stats, key=lambda stat: stat.date):
+                start = period_start(daily_stat.date, resolution)
+                rollup = StatRollup(federation=self, resolution=resolution, date=start)
+                rollup.copy_features(daily_stat)
+                rollups[start] = rollup
+
+            # The periods are consecutive, their range includes no other one
+            StatRollup.objects.filter(federation=self, resolution=resolution,
+                                      date__gte=min(rollups.keys()),
+                                      date__lte=max(rollups.keys())).delete()
+            StatRollup.objects.bulk_create(rollups.values())
+
     def compute_new_stats(self):
         if not self._metadata: return ([], [])
-        entities_from_xml = self._metadata.get_entities()
-
-        entities = Entity.objects.filter(entityid__in=entities_from_xml)
-        entities = entities.prefetch_related('types')
-        Entity_Federations.objects.filter(federation=self)
 
         try:
             first_date = EntityStat.objects.filter(
@@ -236,70 +397,194 @@ class Federation(Base):
             first_date = datetime(2010, 1, 1)
             first_date = pytz.utc.localize(first_date)
 
-        for curtimestamp in self._daterange(first_date, timezone.now() - timedelta(1)):
-            computed = {}
-            not_computed = []
-            entity_stats = []
-            for feature in stats['features'].keys():
-                fun = getattr(self, 'get_%s' % feature, None)
-
-                if callable(fun):
-                    stat = EntityStat()
-                    stat.feature = feature
-                    stat.time = curtimestamp
-                    stat.federation = self
-                    stat.value = fun(
-                        entities, stats['features'][feature], curtimestamp)
-                    entity_stats.append(stat)
-                    computed[feature] = stat.value
-                else:
-                    not_computed.append(feature)
-
-            from_time = datetime.combine(curtimestamp, time.min)
-            if timezone.is_naive(from_time):
-                from_time = pytz.utc.localize(from_time)
-            to_time = datetime.combine(curtimestamp, time.max)
-            if timezone.is_naive(to_time):
-                to_time = pytz.utc.localize(to_time)
-
-            EntityStat.objects.filter(
-                federation=self, time__gte=from_time, time__lte=to_time).delete()
-            EntityStat.objects.bulk_create(entity_stats)
-
+        timestamps = list(self._daterange(first_date, timezone.now() - timedelta(1)))
+        if not timestamps:
+            return ({}, [])
+
+        # Registrations before the day of a timestamp are counted for the
+        # past days, every entity is counted from yesterday on
+        registration_instant = Entity_Federations._meta.get_field('registration_instant')
+        ref_days = np.array([registration_instant.to_python(curtimestamp).toordinal()
+                             for curtimestamp in timestamps])
+        yesterday = pytz.utc.localize(datetime.now() - timedelta(days=1))
+        recent = np.array([curtimestamp >= yesterday for curtimestamp in timestamps], dtype=bool)
+
+        registered, protocols, types = self._get_stat_entities()
+        no_entities = np.zeros(len(registered), dtype=bool)
+        current = self.get_stat_counts() if recent.any() else {}
+
+        values = {}
+        not_computed = []
+        for feature in stats['features'].keys():
+            if not callable(getattr(self, 'get_%s' % feature, None)):
+                not_computed.append(feature)
+                continue
+
+            service_type, protocol = self._get_stat_filter(feature)
+            selected = types.get(service_type, no_entities)
+            if protocol:
+                selected = selected & np.array([protocol in entity_protocols
+                                                for entity_protocols in protocols], dtype=bool)
+
+            dates = np.sort(registered[selected & ~np.isnan(registered)])
+            counts = np.searchsorted(dates, ref_days, side='left')
+            counts[recent] = current.get(feature, 0)
+            values[feature] = counts
+
+        entity_stats = []
+        daily_stats = []
+        for day, curtimestamp in enumerate(timestamps):
+            daily_stat = DailyStat(federation=self, date=curtimestamp.date())
+            for feature, counts in values.iteritems():
+                entity_stats.append(EntityStat(federation=self, feature=feature,
+                                               time=curtimestamp, value=int(counts[day])))
+                if feature in DailyStat.FEATURES:
+                    setattr(daily_stat, feature, int(counts[day]))
+            daily_stats.append(daily_stat)
+
+        from_time = datetime.combine(timestamps[0], time.min)
+        if timezone.is_naive(from_time):
+            from_time = pytz.utc.localize(from_time)
+        to_time = datetime.combine(timestamps[-1], time.max)
+        if timezone.is_naive(to_time):
+            to_time = pytz.utc.localize(to_time)
+
+        EntityStat.objects.filter(
+            federation=self, time__gte=from_time, time__lte=to_time).delete()
+        EntityStat.objects.bulk_create(entity_stats)
+        DailyStat.objects.filter(federation=self, date__gte=timestamps[0].date(),
+                                 date__lte=timestamps[-1].date()).delete()
+        DailyStat.objects.bulk_create(daily_stats)
+        self._update_stat_rollups(daily_stats)
+
+        computed = dict((feature, int(counts[-1])) for feature, counts in values.iteritems())
         return (computed, not_computed)
 
-    def process_metadata_entities(self, request=None, federation_slug=None):
+    def _process_entity_batch(self, batch, memberships, shared_rows, request, federation_slug,
+                              start, checkpoint):
+        # Federations sharing entities would insert the same new entities,
+        # or update the same rows in a different order
+        with SHARED_ROWS_LOCK, transaction.atomic():
+            entities = {}
+            db_entities = Entity.objects.filter(entityid__in=[e['entityid'] for e in batch])
+            for entity in db_entities.prefetch_related('types'):
+                entities[entity.entityid] = entity
+
+            added, modified = self._add_new_entities(entities, batch, memberships, shared_rows,
+                                                     request, federation_slug, start)
+            if checkpoint:
+                checkpoint.add_processed(len(batch))
+            return added, modified
+
+    def process_metadata_entities(self, request=None, federation_slug=None, workers=None,
+                                  checkpoint=None):
         if not self._metadata: return
-        entities_from_xml = self._metadata.get_entities()
-        removed = self._remove_deleted_entities(entities_from_xml)
-
-        entities = {}
-        db_entities = Entity.objects.filter(entityid__in=entities_from_xml)
-        db_entities = db_entities.prefetch_related('types')
-        #TODO add prefetch related, federations, entity_categories
-
-        for entity in db_entities.all():
-            entities[entity.entityid] = entity
+        # Read all the entities with a single pass over the metadata file. An
+        # entityID listed more than once keeps its last EntityDescriptor
+        entities_data = OrderedDict(
+            (entity_data['entityid'], entity_data)
+            for entity_data in self._metadata.iter_entities(details=False, workers=workers))
+        entities_data = entities_data.values()
+
+        # Rows shared by all federations are committed before the federation
+        # transactions start, so that concurrent refreshes see them
+        with SHARED_ROWS_LOCK:
+            shared_rows = (self._get_entity_types(entities_data),
+                           self._get_entity_categories(entities_data))
+
+        with SHARED_ROWS_LOCK, transaction.atomic():
+            removed = self._remove_deleted_entities(self._metadata.get_entity_id_set())
+
+        # Entities whose EntityDescriptor did not change are skipped
+        memberships = self._get_memberships()
+        changed_data = []
+        for entity_data in entities_data:
+            membership = memberships.get(entity_data['entityid'])
+            if membership is None or membership.fingerprint != entity_data.fingerprint:
+                changed_data.append(entity_data)
 
         if request and federation_slug:
             request.session['%s_num_entities' %
-                            federation_slug] = len(entities_from_xml)
+                            federation_slug] = len(changed_data)
             request.session['%s_cur_entities' % federation_slug] = 0
             request.session['%s_process_done' % federation_slug] = False
             request.session.save()
-
-        updated = self._add_new_entities(
-            entities, entities_from_xml, request, federation_slug)
+        if checkpoint:
+            checkpoint.set_stage('entities', len(changed_data))
+
+        # Every batch is committed with the fingerprints of its memberships,
+        # so an interrupted refresh resumes from the first batch not committed
+        added = modified = 0
+        batch_size = _entity_batch_size()
+        for start in range(0, len(changed_data), batch_size):
+            batch = changed_data[start:start + batch_size]
+            try:
+                batch_added, batch_modified = self._process_entity_batch(
+                    batch, memberships, shared_rows, request, federation_slug, start, checkpoint)
+            except IntegrityError:
+                # Entities of the batch added meanwhile by a refresh running
+                # in another process: the batch is read again and retried
+                memberships = self._get_memberships()
+                batch_added, batch_modified = self._process_entity_batch(
+                    batch, memberships, shared_rows, request, federation_slug, start, checkpoint)
+            added += batch_added
+            modified += batch_modified
+
+        self._report_progress(request, federation_slug, len(changed_data), True)
+
+        self.update_metadata_index()
 
         if request and federation_slug:
             request.session['%s_process_done' % federation_slug] = True
             request.session.save()
 
-        return removed, updated
+        return removed, added, modified
 
     def get_absolute_url(self):
         return reverse('federation_view', args=[self.slug])
 
+    def get_stat_counts(self, ref_date=None):
+        """
+        Counts the entities of the federation for every statistics feature
+        with a single aggregate query. Before yesterday only the entities
+        registered before ref_date are counted.
+        """
+        qn = connection.ops.quote_name
+        entity_types = Entity.types.through
+
+        features = []
+        columns = []
+        params = []
+        for feature in stats['features'].keys():
+            service_type, protocol = self._get_stat_filter(feature)
+            condition = 't.%s = %%s' % qn('xmlname')
+            params.append(service_type)
+            if protocol:
+                condition += ' AND e.%s %s' % (qn('_display_protocols'),
+                                               connection.operators['contains'])
+                params.append('%%%s%%' % connection.ops.prep_for_like_query(protocol))
+            columns.append('COUNT(DISTINCT CASE WHEN %s THEN e.%s END)' % (condition, qn('id')))
+            features.append(feature)
+
+        where = 'ef.%s = %%s' % qn('federation_id')
+        params.append(self.pk)
+        if ref_date and ref_date < pytz.utc.localize(datetime.now() - timedelta(days=1)):
+            registration_instant = Entity_Federations._meta.get_field('registration_instant')
+            where += ' AND ef.%s < %%s' % qn('registration_instant')
+            params.append(registration_instant.get_db_prep_value(ref_date, connection))
+
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT %s FROM %s ef JOIN %s e ON e.%s = ef.%s '
+            'JOIN %s et ON et.%s = e.%s JOIN %s t ON t.%s = et.%s WHERE %s' % (
+                ', '.join(columns),
+                qn(Entity_Federations._meta.db_table), qn(Entity._meta.db_table),
+                qn('id'), qn('entity_id'),
+                qn(entity_types._meta.db_table), qn('entity_id'), qn('id'),
+                qn(EntityType._meta.db_table), qn('id'), qn('entitytype_id'), where),
+            params)
+        return dict(zip(features, cursor.fetchone()))
+
     @classmethod
     def get_sp(cls, entities, xml_name, ref_date=None):
         if ref_date and ref_date < pytz.utc.localize(datetime.now() - timedelta(days=1)):
@@ -307,7 +592,7 @@ class Federation(Base):
                 types__xmlname=xml_name, entity_federations__registration_instant__lt=ref_date)
         else:
             selected = entities.filter(types__xmlname=xml_name)
-        return len(selected)
+        return selected.count()
 
     @classmethod
     def get_idp(cls, entities, xml_name, ref_date=None):
@@ -316,7 +601,7 @@ class Federation(Base):
                 types__xmlname=xml_name, entity_federations__registration_instant__lt=ref_date)
         else:
             selected = entities.filter(types__xmlname=xml_name)
-        return len(selected)
+        return selected.count()
 
     @classmethod
     def get_aa(cls, entities, xml_name, ref_date=None):
@@ -325,7 +610,7 @@ class Federation(Base):
                 types__xmlname=xml_name, entity_federations__registration_instant__lt=ref_date)
         else:
             selected = entities.filter(types__xmlname=xml_name)
-        return len(selected)
+        return selected.count()
 
     def get_sp_saml1(self, entities, xml_name, ref_date=None):
         return self.get_stat_protocol(entities, xml_name, 'SPSSODescriptor', ref_date)
@@ -354,7 +639,7 @@ class Federation(Base):
             selected = entities.filter(types__xmlname=service_type,
                                        _display_protocols__contains=xml_name)
 
-        return len(selected)
+        return selected.count()
 
     def can_edit(self, user, delete):
         if user.is_superuser:
@@ -383,6 +668,13 @@ def federation_pre_save(sender, instance, **kwargs):
         instance.slug = slugify(unicode(instance))[:200]
 
 
+@receiver(post_save, sender=Federation, dispatch_uid='federation_post_save')
+@receiver(post_delete, sender=Federation, dispatch_uid='federation_post_delete')
+def federation_summary_changed(sender, instance, **kwargs):
+    # The summary groups the counts by federation and country
+    FederationSummary.invalidate()
+
+
 @receiver(pre_save, sender=Entity, dispatch_uid='entity_pre_save')
 def entity_pre_save(sender, instance, **kwargs):
     # if refetch and instance.file_url:
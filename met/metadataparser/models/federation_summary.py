@@ -0,0 +1,122 @@
+##########################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+##########################################################################
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models, transaction
+from django.db.models import Count
+from django.utils.translation import ugettext_lazy as _
+
+from met.metadataparser.models.base import JSONField
+from met.metadataparser.models.entity import Entity
+
+SUMMARY_CACHE_KEY = 'federation_summary'
+SUMMARY_CACHE_TIMEOUT = getattr(settings, 'SUMMARY_CACHE_TIMEOUT', 24 * 60 * 60)
+
+
+class FederationSummary(models.Model):
+    """
+    Entity counts of a federation shown by the index page, computed by the
+    refresh. The row without federation holds the counts of all entities.
+    """
+
+    federation = models.OneToOneField('Federation', blank=True, null=True,
+                                      related_name='summary',
+                                      verbose_name=_(u'Federation'))
+
+    total = models.PositiveIntegerField(default=0,
+                                        verbose_name=_(u'Entities'))
+
+    types = JSONField(blank=True, null=True, max_length=5000, editable=False,
+                      verbose_name=_(u'Entities by type'))
+
+    updated = models.DateTimeField(auto_now=True,
+                                   verbose_name=_(u'Last update time'))
+
+    def __unicode__(self):
+        return u'%s: %d' % (self.federation or 'All', self.total)
+
+    @classmethod
+    def update_all(cls):
+        """
+        Recomputes the counts of every federation and refreshes the cache.
+        """
+        summaries = {}
+
+        def get_summary(federation_id):
+            if federation_id not in summaries:
+                summaries[federation_id] = cls(federation_id=federation_id, types={})
+            return summaries[federation_id]
+
+        for count in Entity.objects.values('federations__id').annotate(Count('federations__id')):
+            if count['federations__id'] is not None:
+                get_summary(count['federations__id']).total = count['federations__id__count']
+
+        type_counts = Entity.objects.values('federations__id', 'types__xmlname').annotate(
+            Count('federations__id'))
+        for count in type_counts:
+            if count['federations__id'] is not None and count['types__xmlname'] is not None:
+                get_summary(count['federations__id']).types[count['types__xmlname']] = \
+                    count['federations__id__count']
+
+        all_entities = get_summary(None)
+        all_entities.total = Entity.objects.count()
+        for count in Entity.objects.values('types__xmlname').annotate(Count('types__xmlname')):
+            if count['types__xmlname'] is not None:
+                all_entities.types[count['types__xmlname']] = count['types__xmlname__count']
+
+        with transaction.atomic():
+            cls.objects.all().delete()
+            cls.objects.bulk_create(summaries.values())
+
+        cls.invalidate()
+        return cls.get_summary()
+
+    @classmethod
+    def invalidate(cls):
+        """
+        Removes the summary from the cache, it is read again from the
+        table when needed.
+        """
+        cache.delete(SUMMARY_CACHE_KEY)
+
+    @classmethod
+    def get_summary(cls):
+        """
+        Returns the counts of the index page as dicts: 'counts' maps every
+        entity type, and 'All', to the counts keyed by federation id,
+        'totals' holds the counts of all entities by type, 'total' the
+        number of entities and 'countries' the entities of the federations
+        of every country.
+        """
+        summary = cache.get(SUMMARY_CACHE_KEY)
+        if summary is not None:
+            return summary
+
+        summary = {'counts': {'All': {}}, 'totals': {}, 'total': 0, 'countries': {}}
+        for row in cls.objects.select_related('federation').only(
+                'total', 'types', 'federation__country'):
+            types = row.types or {}
+            if row.federation is None:
+                summary['totals'] = types
+                summary['total'] = row.total
+                continue
+
+            summary['counts']['All'][row.federation_id] = row.total
+            for xmlname, count in types.iteritems():
+                summary['counts'].setdefault(xmlname, {})[row.federation_id] = count
+            country = row.federation.country
+            if country is not None:
+                summary['countries'][country] = summary['countries'].get(country, 0) + row.total
+
+        cache.set(SUMMARY_CACHE_KEY, summary, SUMMARY_CACHE_TIMEOUT)
+        return summary
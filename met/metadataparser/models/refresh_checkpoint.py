@@ -0,0 +1,73 @@
+##########################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+##########################################################################
+
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+REFRESH_STAGES = (
+    ('pending', _(u'Pending')),
+    ('fetch', _(u'Fetching metadata')),
+    ('federation', _(u'Updating federation')),
+    ('entities', _(u'Updating entities')),
+    ('stats', _(u'Computing statistics')),
+    ('done', _(u'Done')),
+    ('failed', _(u'Failed')),
+)
+
+
+class RefreshCheckpoint(models.Model):
+    """
+    Progress of the last metadata refresh of a federation.
+    """
+
+    federation = models.OneToOneField('Federation', related_name='refresh_checkpoint',
+                                      verbose_name=_(u'Federation'))
+
+    run_started = models.DateTimeField(verbose_name=_(u'Refresh run start time'))
+
+    stage = models.CharField(max_length=20, choices=REFRESH_STAGES, default='pending',
+                             verbose_name=_(u'Refresh stage'))
+
+    processed = models.PositiveIntegerField(default=0,
+                                            verbose_name=_(u'Processed entities'))
+
+    total = models.PositiveIntegerField(default=0,
+                                        verbose_name=_(u'Entities to process'))
+
+    updated = models.DateTimeField(auto_now=True,
+                                   verbose_name=_(u'Last update time'))
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.federation, self.stage)
+
+    @property
+    def interrupted(self):
+        """
+        True if a refresh started working on the federation and did not
+        complete, so the database may not match the metadata file.
+        """
+        return self.stage not in ('pending', 'done')
+
+    def set_stage(self, stage, total=0):
+        self.stage = stage
+        self.processed = 0
+        self.total = total
+        self.save()
+
+    def set_failed(self):
+        # The progress is kept to show where the refresh stopped
+        self.stage = 'failed'
+        self.save(update_fields=['stage', 'updated'])
+
+    def add_processed(self, count):
+        self.processed += count
+        self.save(update_fields=['processed', 'updated'])
@@ -10,14 +10,19 @@
 # Consortium GARR, http://www.garr.it
 ##########################################################################
 
+import time
 import logging
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from django.conf import settings
-from django.db.models import Count
+from django.db import connection, reset_queries
+from django.db.models import Count, Max
+from django.utils import timezone
 
 from met.metadataparser.utils import send_mail, send_slack
-from met.metadataparser.models import Federation, Entity, EntityCategory
+from met.metadataparser.models import Federation, Entity, EntityCategory, RefreshCheckpoint, FederationSummary
+from met.metadataparser.xmlparser import CERTIFICATE_CACHE
 
 if settings.PROFILE:
     from silk.profiling.profiler import silk_profile as profile
@@ -46,65 +51,215 @@ def _fetch_new_metadata_file(federation, logger):
         return "%s" % errorMessage, False
 
 
-def refresh(fed_name=None, force_refresh=False, logger=None):
+class QueryCounter(object):
+    """
+    Counts the database queries run inside a with block.
+    """
+
+    def __enter__(self):
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        self.count = 0
+        return self
+
+    def __exit__(self, *args):
+        self.count = len(connection.queries) - self.start
+        connection.use_debug_cursor = self.use_debug_cursor
+        if not settings.DEBUG:
+            reset_queries()
+
+
+def _load_certificate_cache(logger):
+    CERTIFICATE_CACHE.maxsize = getattr(settings, 'CERTIFICATE_CACHE_SIZE', CERTIFICATE_CACHE.maxsize)
+    try:
+        CERTIFICATE_CACHE.load(getattr(settings, 'CERTIFICATE_CACHE_FILE', None))
+    except Exception, errorMessage:
+        log('Certificate cache could not be loaded: %s' % errorMessage, logger, logging.ERROR)
+    CERTIFICATE_CACHE.reset_stats()
+
+
+def _save_certificate_cache(logger):
+    log('Certificate cache: %d hits, %d misses, %d certificates cached.' %
+        (CERTIFICATE_CACHE.hits, CERTIFICATE_CACHE.misses, len(CERTIFICATE_CACHE)), logger, logging.INFO)
+    try:
+        CERTIFICATE_CACHE.save()
+    except Exception, errorMessage:
+        log('Certificate cache could not be saved: %s' % errorMessage, logger, logging.ERROR)
+
+
+def _refresh_federation(federation, force_refresh, logger, workers, checkpoint):
+    start_time = time.time()
+    error_msg = None
+    try:
+        log('[%s] Refreshing metadata ...' %
+            federation, logger, logging.INFO)
+        checkpoint.set_stage('fetch')
+        error_msg, data_changed = _fetch_new_metadata_file(
+            federation, logger)
+
+        if not error_msg and (force_refresh or data_changed):
+            log('[%s] Updating database ...' %
+                federation, logger, logging.INFO)
+
+            log('[%s] Updating federation ...' %
+                federation, logger, logging.DEBUG)
+            checkpoint.set_stage('federation')
+            federation.process_metadata()
+            federation.save()
+
+            log('[%s] Updating federation entities ...' %
+                federation, logger, logging.DEBUG)
+            with QueryCounter() as queries:
+                removed, added, modified = federation.process_metadata_entities(
+                    workers=workers, checkpoint=checkpoint)
+            log('[%s] Removed %s old entities, added %s and modified %s entities with %s queries.' %
+                (federation, removed, added, modified, queries.count), logger, logging.INFO)
+
+            log('[%s] Updating federation file and metadata_data...' %
+                federation, logger, logging.DEBUG)
+            federation.metadata_update = datetime.now()
+            federation.save(update_fields=['file', 'file_validators', 'metadata_update'])
+            log('[%s] Federation update time modified with %s' % (
+                federation, federation.metadata_update), logger, logging.INFO)
+
+        log('[%s] Updating entity offset index ...' %
+            federation, logger, logging.DEBUG)
+        federation.update_metadata_index()
+
+        log('[%s] Updating federation statistics ...' %
+            federation, logger, logging.DEBUG)
+        checkpoint.set_stage('stats')
+        (computed, not_computed) = federation.compute_new_stats()
+        log('[%s] Computed statistics: %s' %
+            (federation, computed), logger, logging.DEBUG)
+        log('[%s] NOT Computed statistics: %s' %
+            (federation, not_computed), logger, logging.DEBUG)
+
+    except Exception, e:
+        if error_msg is None:
+            error_msg = '%s' % e
+        error_msg = '%s\n%s' % (error_msg, e)
+
+    finally:
+        if error_msg:
+            log('Sending following error via email: %s' %
+                error_msg, logger, logging.INFO)
+            _send_message_via_email_and_slack(
+                error_msg, federation, logger)
+
+        # Recorded after the error is reported, the database may be failing
+        try:
+            if error_msg:
+                checkpoint.set_failed()
+            else:
+                checkpoint.set_stage('done')
+        except Exception, errorMessage:
+            log('[%s] Refresh progress could not be saved: %s' %
+                (federation, errorMessage), logger, logging.ERROR)
+
+        log('[%s] Refreshed in %.1f seconds.' %
+            (federation, time.time() - start_time), logger, logging.INFO)
+
+
+def _refresh_federation_thread(args):
+    try:
+        _refresh_federation(*args)
+    finally:
+        # Every thread has its own database connection
+        connection.close()
+
+
+def _start_checkpoints(federations, run_started):
+    """
+    Records the start of a new run for the federations and returns their
+    checkpoints, together with the federations whose previous refresh
+    did not complete.
+    """
+    checkpoints = {}
+    interrupted = set()
+    for federation in federations:
+        try:
+            checkpoint = federation.refresh_checkpoint
+            if checkpoint.interrupted:
+                interrupted.add(federation.pk)
+        except RefreshCheckpoint.DoesNotExist:
+            checkpoint = RefreshCheckpoint(federation=federation)
+        checkpoint.run_started = run_started
+        checkpoint.set_stage('pending')
+        checkpoints[federation.pk] = checkpoint
+    return checkpoints, interrupted
+
+
+def _resume_checkpoints(federations):
+    """
+    Returns the checkpoints of the federations that the last run did not
+    complete.
+    """
+    last_run = RefreshCheckpoint.objects.aggregate(Max('run_started'))['run_started__max']
+    checkpoints = RefreshCheckpoint.objects.filter(run_started=last_run).exclude(stage='done')
+    checkpoints = dict((checkpoint.federation_id, checkpoint) for checkpoint in checkpoints)
+    return dict((federation.pk, checkpoints[federation.pk])
+                for federation in federations if federation.pk in checkpoints)
+
+
+def refresh_status(fed_name=None, logger=None):
+    """
+    Logs the progress of the last refresh of every federation.
+    """
+    checkpoints = RefreshCheckpoint.objects.select_related('federation').order_by('federation__name')
+    for checkpoint in checkpoints:
+        if fed_name and checkpoint.federation.slug != fed_name:
+            continue
+        progress = ''
+        if checkpoint.total and checkpoint.stage in ('entities', 'failed'):
+            progress = ' (%d/%d entities)' % (checkpoint.processed, checkpoint.total)
+        log('[%s] %s%s, run started %s, updated %s' % (
+            checkpoint.federation, checkpoint.get_stage_display(), progress,
+            checkpoint.run_started, checkpoint.updated), logger, logging.INFO)
+
+
+def refresh(fed_name=None, force_refresh=False, logger=None, workers=None, concurrency=None,
+            resume=False):
+    if workers and workers > 1 and concurrency and concurrency > 1:
+        # The worker processes would be forked from a process running threads,
+        # inheriting the locks they hold
+        raise ValueError('Entity workers cannot be used with concurrent federation refreshes')
+
     log('Starting refreshing metadata ...', logger, logging.INFO)
+    _load_certificate_cache(logger)
 
     federations = Federation.objects.all()
     federations.prefetch_related('etypes', 'federations')
     #TODO prefetch related, add federations->entity_categories
 
-    for federation in federations:
-        if fed_name and federation.slug != fed_name:
-            continue
+    federations = [federation for federation in federations
+                   if not fed_name or federation.slug == fed_name]
 
-        error_msg = None
-        try:
-            log('[%s] Refreshing metadata ...' %
-                federation, logger, logging.INFO)
-            error_msg, data_changed = _fetch_new_metadata_file(
-                federation, logger)
-
-            if not error_msg and (force_refresh or data_changed):
-                log('[%s] Updating database ...' %
-                    federation, logger, logging.INFO)
-
-                log('[%s] Updating federation ...' %
-                    federation, logger, logging.DEBUG)
-                federation.process_metadata()
-                federation.save()
-
-                log('[%s] Updating federation entities ...' %
-                    federation, logger, logging.DEBUG)
-                removed, updated = federation.process_metadata_entities()
-                log('[%s] Removed %s old entities and updated %s entities.' %
-                    (federation, removed, updated), logger, logging.INFO)
-
-                log('[%s] Updating federation file and metadata_data...' %
-                    federation, logger, logging.DEBUG)
-                federation.metadata_update = datetime.now()
-                federation.save(update_fields=['file', 'metadata_update'])
-                log('[%s] Federation update time modified with %s' % (
-                    federation, federation.metadata_update), logger, logging.INFO)
-
-            log('[%s] Updating federation statistics ...' %
-                federation, logger, logging.DEBUG)
-            (computed, not_computed) = federation.compute_new_stats()
-            log('[%s] Computed statistics: %s' %
-                (federation, computed), logger, logging.DEBUG)
-            log('[%s] NOT Computed statistics: %s' %
-                (federation, not_computed), logger, logging.DEBUG)
+    if resume:
+        checkpoints = _resume_checkpoints(federations)
+        federations = [federation for federation in federations if federation.pk in checkpoints]
+        interrupted = set(pk for pk, checkpoint in checkpoints.iteritems() if checkpoint.interrupted)
+        log('Resuming %d federations not completed by the last run ...' %
+            len(federations), logger, logging.INFO)
+    else:
+        checkpoints, interrupted = _start_checkpoints(federations, timezone.now())
 
-        except Exception, e:
-            if error_msg is None:
-                error_msg = '%s' % e
-            error_msg = '%s\n%s' % (error_msg, e)
+    # The database of an interrupted federation may not match its metadata
+    # file, which is already fetched: its entities are updated anyway
+    jobs = [(federation, force_refresh or federation.pk in interrupted, logger, workers,
+             checkpoints[federation.pk]) for federation in federations]
 
+    if concurrency and concurrency > 1 and len(jobs) > 1:
+        pool = ThreadPool(min(concurrency, len(jobs)))
+        try:
+            pool.map(_refresh_federation_thread, jobs, 1)
         finally:
-            if error_msg:
-                log('Sending following error via email: %s' %
-                    error_msg, logger, logging.INFO)
-                _send_message_via_email_and_slack(
-                    error_msg, federation, logger)
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            _refresh_federation(*job)
 
     try:
         log('Removing entity categories with no entity associated...', logger, logging.INFO)
@@ -120,6 +275,13 @@ def refresh(fed_name=None, force_refresh=False, logger=None):
     except Exception, errorMessage:
         log('Error: %s' % errorMessage, logger, logging.ERROR)
 
+    try:
+        log('Updating federation summaries...', logger, logging.INFO)
+        FederationSummary.update_all()
+    except Exception, errorMessage:
+        log('Error: %s' % errorMessage, logger, logging.ERROR)
+
+    _save_certificate_cache(logger)
     log('Refreshing metadata terminated.', logger, logging.INFO)
 
 
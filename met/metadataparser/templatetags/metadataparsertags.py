@@ -87,7 +87,7 @@ def interfederations_summary(context, queryname, counts, federations=None):
             'entity_types': DESCRIPTOR_TYPES}
 
 @register.inclusion_tag('metadataparser/tag_entity_list.html', takes_context=True)
-def entity_list(context, entities, categories=None, pagination=None, curfed=None, show_total=True, append_query=None, onclick_page=None, onclick_export=None):
+def entity_list(context, entities, categories=None, pagination=None, curfed=None, show_total=True, append_query=None, onclick_page=None, onclick_export=None, onclick_cursor=None):
     request = context.get('request', None)
     lang = 'en'
     if request:
@@ -104,6 +104,7 @@ def entity_list(context, entities, categories=None, pagination=None, curfed=None
             'pagination': pagination,
             'onclick_page': onclick_page,
             'onclick_export': onclick_export,
+            'onclick_cursor': onclick_cursor,
             'entity_types': DESCRIPTOR_TYPES}
 
 
@@ -245,31 +246,24 @@ def entities_count(entity_qs, entity_type=None):
 
 @register.simple_tag()
 def get_fed_total(totals, entity_type='All'):
-    tot_count = 0
-    for curtotal in totals:
-        if entity_type == 'All' or curtotal['types__xmlname'] == entity_type:
-            tot_count += curtotal['types__xmlname__count']
-    return tot_count
+    if entity_type == 'All':
+        return sum(totals.values())
+    return totals.get(entity_type, 0)
 
 
 @register.simple_tag()
 def get_fed_count(counts, federation='All', entity_type='All'):
-    count = counts[entity_type]
-
-    fed_count = 0
-    for curcount in count:
-        if federation == 'All' or curcount['federations__id'] == federation:
-            fed_count += curcount['federations__id__count']
-    return fed_count
+    count = counts.get(entity_type, {})
+    if federation == 'All':
+        return sum(count.values())
+    return count.get(federation, 0)
 
 
 @register.simple_tag()
 def get_fed_count_by_country(count, country='All'):
-    fed_count = 0
-    for curcount in count:
-        if country == 'All' or curcount['federations__country'] == country:
-            fed_count += curcount['federations__country__count']
-    return fed_count
+    if country == 'All':
+        return sum(count.values())
+    return count.get(country, 0)
 
 
 @register.simple_tag(takes_context=True)
@@ -28,6 +28,24 @@ def compare_filecontents(a, b):
     return md5_a == md5_b
 
 
+class DigestWriter(object):
+    """
+    File-like wrapper computing the MD5 digest of the data written to
+    the wrapped file.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.digest = hashlib.md5()
+
+    def write(self, data):
+        self.digest.update(data)
+        self.output.write(data)
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+
 def _connect_to_smtp(server, port=25, login_type=None, username=None, password=None):
     smtp_send = smtplib.SMTP(server, port)
     smtp_send.ehlo()
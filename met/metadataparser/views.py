@@ -11,7 +11,6 @@
 #########################################################################################
 
 import re, time
-import pytz
 import operator
 import simplejson as json
 import numpy as np
@@ -20,7 +19,7 @@ from datetime import datetime
 from dateutil import tz
 
 from django.conf import settings
-from django.db.models import Count, Q
+from django.db.models import Q
 from django.contrib import messages
 from django.contrib.auth import logout
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
@@ -29,21 +28,21 @@ from django.http import HttpResponse, HttpResponseRedirect, HttpResponseBadReque
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template import RequestContext
 from django.utils.translation import ugettext_lazy as _
-from django.utils import timezone
 
 from chartit import DataPool, Chart
 
 from datetime import datetime
 
 from met.metadataparser.decorators import user_can_edit
-from met.metadataparser.models import Federation, Entity, EntityStat, EntityCategory, Entity_Federations, TOP_LENGTH, FEDERATION_TYPES
+from met.metadataparser.models import Federation, Entity, EntityStat, DailyStat, StatRollup, FederationSummary, EntityCategory, Entity_Federations, TOP_LENGTH, FEDERATION_TYPES
+from met.metadataparser.models.daily_stat import ROLLUP_RESOLUTIONS, period_start, period_count
 from met.metadataparser.forms import (FederationForm, EntityForm, EntityCommentForm,
                                       EntityProposalForm, ServiceSearchForm, ChartForm, SearchEntitiesForm)
 
 from met.metadataparser.summary_export import export_summary
 from met.metadataparser.query_export import export_query_set
 from met.metadataparser.entity_export import export_entity
-from met.metadataparser.xmlparser import DESCRIPTOR_TYPES
+from met.metadataparser.xmlparser import DESCRIPTOR_TYPES, DESCRIPTOR_TYPES_DISPLAY
 from met.metadataparser.utils import send_mail
 
 if settings.PROFILE:
@@ -53,6 +52,9 @@ else:
 
 RESCUE_SLASH = re.compile(r"^(http(?:|s):/)([^/])")
 
+def _chart_max_points():
+    return getattr(settings, 'STATS_CHART_MAX_POINTS', 31)
+
 def increment_current_toplength(request):
     current_top_length = request.session.get('currentTopLength', TOP_LENGTH)
     current_top_length += TOP_LENGTH
@@ -102,28 +104,17 @@ def index(request):
         else:
             federations.append(f)
 
-    cc = Entity.objects.values('federations__id', 'types__xmlname').annotate(Count('federations__id'), Count('types__xmlname'))
-    counts = {}
-    for curtype in DESCRIPTOR_TYPES:
-        counts[curtype] = []
-        for c in cc:
-            if c['types__xmlname'] == curtype:
-                counts[curtype].append(c)
-    counts['All'] = Entity.objects.values('federations__id').annotate(Count('federations__id'))
-
-    totals = Entity.objects.values('types__xmlname').annotate(Count('types__xmlname'))
-
-    fed_countries = Entity.objects.values('federations__country').annotate(Count('federations__country'))
+    summary = FederationSummary.get_summary()
 
     params = {
        'settings': settings,
        'interfederations': interfederations,
        'federations': federations,
-       'fed_countries': fed_countries,
+       'fed_countries': summary['countries'],
        'entity_types': DESCRIPTOR_TYPES,
        'federation_path': request.path,
-       'counts': counts,
-       'totals': totals,
+       'counts': summary['counts'],
+       'totals': summary['totals'],
     }
 
     export = request.GET.get('export', None)
@@ -151,8 +142,14 @@ def most_federated_entities(request):
     
     return render_to_response('metadataparser/most_federated_entities.html', params, context_instance=RequestContext(request))
 
+def _entity_page_size():
+    return getattr(settings, 'ENTITY_PAGE_SIZE', 20)
+
+def _keyset_pagination():
+    return getattr(settings, 'ENTITY_KEYSET_PAGINATION', False)
+
 def _paginate_fed(ob_entities, page):
-    paginator = Paginator(ob_entities, 20)
+    paginator = Paginator(ob_entities, _entity_page_size())
 
     try:
         ob_entities = paginator.page(page)
@@ -174,6 +171,73 @@ def _paginate_fed(ob_entities, page):
         'objects': ob_entities.object_list,
     }
 
+def _keyset_paginate_fed(ob_entities, after=None, before=None, num_objects=None):
+    """
+    Returns the page of entities that follows the entityid after, or
+    precedes the entityid before, in entityid order. Neither the rows of
+    the previous pages nor the entities are counted: num_objects is the
+    total shown, None if it is not known.
+    """
+    page_size = _entity_page_size()
+    ob_entities = ob_entities.order_by('entityid')
+    if before:
+        objects = list(ob_entities.filter(entityid__lt=before).reverse()[:page_size + 1])
+        has_previous = len(objects) > page_size
+        objects = objects[:page_size][::-1]
+        has_next = True
+    else:
+        if after:
+            ob_entities = ob_entities.filter(entityid__gt=after)
+        objects = list(ob_entities[:page_size + 1])
+        has_next = len(objects) > page_size
+        objects = objects[:page_size]
+        has_previous = bool(after)
+
+    return {
+        'keyset': True,
+        'previous_cursor': objects[0].entityid if objects and has_previous else None,
+        'next_cursor': objects[-1].entityid if objects and has_next else None,
+        'num_objects': num_objects,
+        'objects': objects,
+    }
+
+def _summary_total(federation_id=None, entity_type=None):
+    """
+    Returns the number of entities of a federation, or of all of them, of
+    the given type from the precomputed summary.
+    """
+    summary = FederationSummary.get_summary()
+    if federation_id is None:
+        if entity_type:
+            return summary['totals'].get(entity_type, 0)
+        return summary['total']
+    return summary['counts'].get(entity_type or 'All', {}).get(federation_id, 0)
+
+def _search_total(entity_type, federations, entity_id, entity_category):
+    """
+    Returns the number of entities found by a search from the precomputed
+    summary, None if the search filters more than one federation, the
+    entity ids or the entity categories.
+    """
+    if entity_id or (entity_category and entity_category != 'All'):
+        return None
+
+    federation_id = None
+    if federations and not 'All' in federations:
+        if len(federations) > 1:
+            return None
+        federation_id = int(federations[0])
+
+    xmlname = None
+    if entity_type and entity_type != 'All':
+        xmlnames = [xmlname for xmlname, name in DESCRIPTOR_TYPES_DISPLAY.items()
+                    if name == entity_type]
+        if not xmlnames:
+            return None
+        xmlname = xmlnames[0]
+
+    return _summary_total(federation_id, xmlname)
+
 @profile(name='Federation view')
 def federation_view(request, federation_slug=None):
     if federation_slug:
@@ -204,7 +268,12 @@ def federation_view(request, federation_slug=None):
         entity_category = request.GET['entity_category']
 
     ob_entities = ob_entities.prefetch_related('types', 'federations')
-    pagination = _paginate_fed(ob_entities, request.GET.get('page'))
+    if _keyset_pagination():
+        pagination = _keyset_paginate_fed(ob_entities, request.GET.get('after'),
+                                          request.GET.get('before'),
+                                          _summary_total(federation.id, entity_type))
+    else:
+        pagination = _paginate_fed(ob_entities, request.GET.get('page'))
 
     entities = []
     for entity in pagination['objects']:
@@ -283,6 +352,7 @@ def federation_edit(request, federation_slug=None):
 def federation_update_entities(request, federation_slug=None):
     federation = get_object_or_404(Federation, slug=federation_slug)
     federation.process_metadata_entities(request=request, federation_slug=federation_slug)
+    FederationSummary.update_all()
 
     messages.success(request, _('Federation entities updated succesfully'))
     return HttpResponse("Done. All entities updated.", content_type='text/plain')
@@ -310,9 +380,28 @@ def federation_delete(request, federation_slug):
                      _(u"%(federation)s federation was deleted successfully"
                      % {'federation': unicode(federation)}))
     federation.delete()
+    FederationSummary.update_all()
     return HttpResponseRedirect(reverse('index'))
 
 
+def _get_chart_stats(federation, from_date, to_date):
+    """
+    Returns the daily statistics of the range, or the rollups of the
+    shortest period giving no more than STATS_CHART_MAX_POINTS points.
+    """
+    max_points = _chart_max_points()
+    if period_count(from_date, to_date, 'day') <= max_points:
+        chart_stats = DailyStat.objects.filter(federation=federation)
+    else:
+        for resolution, label in ROLLUP_RESOLUTIONS:
+            if period_count(from_date, to_date, resolution) <= max_points:
+                break
+        chart_stats = StatRollup.objects.filter(federation=federation, resolution=resolution)
+        from_date = period_start(from_date, resolution)
+
+    return chart_stats.filter(date__gte=from_date, date__lte=to_date).order_by('date')
+
+
 @profile(name='Index charts')
 def federation_charts(request, federation_slug=None):
     if federation_slug is None:
@@ -330,67 +419,36 @@ def federation_charts(request, federation_slug=None):
             
             protocols = stats_config_dict['protocols']
 
-            from_time = datetime.fromordinal(form.cleaned_data['fromDate'].toordinal())
-            if timezone.is_naive(from_time):
-                from_time = pytz.utc.localize(from_time)
-            to_time = datetime.fromordinal(form.cleaned_data['toDate'].toordinal() + 1)
-            if timezone.is_naive(to_time):
-                to_time = pytz.utc.localize(to_time)
-
-            service_stats = EntityStat.objects.filter(  federation=federation \
-                                              , feature__in = service_terms \
-                                              , time__gte = from_time \
-                                              , time__lte = to_time).order_by("time")
-
-            protocol_stats = EntityStat.objects.filter(  federation=federation \
-                                              , feature__in = protocol_terms \
-                                              , time__gte = from_time \
-                                              , time__lte = to_time).order_by("time")
-
-            s_chart = []
-
-            if len(service_stats) > 0:
-                cur_data = service_stats[0].time.strftime('%d/%m/%y')
-                cur_stat = { 'date': cur_data }
-                for s in service_stats:
-                    if s.time.strftime('%d/%m/%y') != cur_data:
-                        s_chart.append(cur_stat)
-                        cur_data = s.time.strftime('%d/%m/%y')
-                        cur_stat = { 'date': cur_data }
-                    
-                    cur_stat[s.feature] = s.value
-                s_chart.append(cur_stat)
-
-            p_chart = []
-            if len(protocol_stats) > 0:
-                cur_data = protocol_stats[0].time.strftime('%d/%m/%y')
-                cur_stat = { 'date': cur_data }
-                for p in protocol_stats:
-                    if p.time.strftime('%d/%m/%y') != cur_data:
-                        p_chart.append(cur_stat)
-                        cur_data = p.time.strftime('%d/%m/%y')
-                        cur_stat = { 'date': cur_data }
-
-                    cur_stat[p.feature] = p.value
-                p_chart.append(cur_stat)
-
-            p_chart_axis_max = 0
-            for p in p_chart:
-               newval = p['sp_shib1'] + p['idp_shib1']
-               if newval > p_chart_axis_max: p_chart_axis_max = newval
-               newval = p['sp_saml1'] + p['idp_saml1']
-               if newval > p_chart_axis_max: p_chart_axis_max = newval
-               newval = p['sp_saml2'] + p['idp_saml2']
-               if newval > p_chart_axis_max: p_chart_axis_max = newval
-
-            return render_to_response('metadataparser/federation_chart.html',
-                                      {'form': form,
-                                       'statcharts': True, 
-                                       's_chart': s_chart,
-                                       'p_chart': p_chart,
-                                       'p_chart_axis_max': p_chart_axis_max,
-                                      },
-                                      context_instance=RequestContext(request))
+            # The charts are read from the columns of the daily statistics
+            unknown_terms = [term for term in service_terms + protocol_terms
+                             if term not in DailyStat.FEATURES]
+            if unknown_terms:
+                messages.error(request, _(u'Statistics not available for the charts: %s')
+                               % ', '.join(unknown_terms))
+            else:
+                # One row per point, with a column for every feature
+                chart_stats = _get_chart_stats(federation, form.cleaned_data['fromDate'],
+                                               form.cleaned_data['toDate'])
+
+                s_chart = p_chart = list(chart_stats.values('date', *(service_terms + protocol_terms)))
+
+                p_chart_axis_max = 0
+                for p in p_chart:
+                   newval = p['sp_shib1'] + p['idp_shib1']
+                   if newval > p_chart_axis_max: p_chart_axis_max = newval
+                   newval = p['sp_saml1'] + p['idp_saml1']
+                   if newval > p_chart_axis_max: p_chart_axis_max = newval
+                   newval = p['sp_saml2'] + p['idp_saml2']
+                   if newval > p_chart_axis_max: p_chart_axis_max = newval
+
+                return render_to_response('metadataparser/federation_chart.html',
+                                          {'form': form,
+                                           'statcharts': True, 
+                                           's_chart': s_chart,
+                                           'p_chart': p_chart,
+                                           'p_chart_axis_max': p_chart_axis_max,
+                                          },
+                                          context_instance=RequestContext(request))
 
         else:
             messages.error(request, _('Please correct the errors indicated'
@@ -772,7 +830,12 @@ def search_entities(request):
                 ob_entities = ob_entities.filter(*eid_args)
 
             ob_entities = ob_entities.prefetch_related('types', 'federations')
-            pagination = _paginate_fed(ob_entities, form.cleaned_data['page'])
+            if _keyset_pagination():
+                num_objects = _search_total(entity_type, federations, entity_id, entity_category)
+                pagination = _keyset_paginate_fed(ob_entities, form.cleaned_data['after'],
+                                                  form.cleaned_data['before'], num_objects)
+            else:
+                pagination = _paginate_fed(ob_entities, form.cleaned_data['page'])
 
             entities = []
             for entity in pagination['objects']:
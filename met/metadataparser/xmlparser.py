@@ -10,6 +10,16 @@
 # Consortium GARR, http://www.garr.it
 ##########################################################################
 
+import os
+import re
+import mmap
+import base64
+import sqlite3
+import hashlib
+import threading
+import cPickle as pickle
+import multiprocessing
+from collections import OrderedDict
 from lxml import etree
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
@@ -63,19 +73,505 @@ FEDERATION_ROOT_TAG = addns('EntitiesDescriptor')
 ENTITY_ROOT_TAG = addns('EntityDescriptor')
 
 
-class MetadataParser(object):
+def _xpath(expression):
+    return etree.XPath(expression, namespaces=NAMESPACES)
+
+# XPath expressions used by the extractors, compiled once at import time
+XPATHS = {
+    'entity_types': _xpath("|".join(DESCRIPTOR_TYPES_UTIL)),
+    'entity_categories': _xpath(".//mdattr:EntityAttributes"
+                                "//saml:Attribute[@Name='http://macedir.org/entity-category-support' or @Name='http://macedir.org/entity-category' or @Name='urn:oasis:names:tc:SAML:attribute:assurance-certification']"
+                                "//saml:AttributeValue"),
+    'certificates': _xpath(".//ds:X509Certificate"),
+    'displayname': _xpath(".//mdui:UIInfo//mdui:DisplayName"),
+    'description': _xpath(".//mdui:UIInfo//mdui:Description"),
+    'information_url': _xpath(".//mdui:UIInfo//mdui:InformationURL"),
+    'privacy_url': _xpath(".//mdui:UIInfo//mdui:PrivacyStatementURL"),
+    'organization': _xpath(".//md:Organization"),
+    'logos': _xpath(".//mdui:UIInfo//mdui:Logo"),
+    'registration_information': _xpath(".//md:Extensions//mdrpi:RegistrationInfo"),
+    'registration_policy': _xpath(".//md:Extensions"
+                                  "//mdrpi:RegistrationInfo"
+                                  "//mdrpi:RegistrationPolicy"),
+    'attribute_scope': _xpath(".//md:Extensions//shibmd:Scope"),
+    'requested_attributes': _xpath(".//md:AttributeConsumingService"
+                                   "//md:RequestedAttribute"),
+    'contacts': _xpath(".//md:ContactPerson"),
+    'contact_name': _xpath(".//md:GivenName"),
+    'contact_surname': _xpath(".//md:SurName"),
+    'contact_email': _xpath(".//md:EmailAddress"),
+}
+
+for item in DESCRIPTOR_TYPES:
+    XPATHS['protocols_%s' % item] = _xpath(
+        ".//md:%s/@protocolSupportEnumeration" % item)
+
+# Qualified tags read by the single traversal entity extractor
+UIINFO_TAG = addns('UIInfo', MDUI_NAMESPACE)
+LOGO_TAG = addns('Logo', MDUI_NAMESPACE)
+EXTENSIONS_TAG = addns('Extensions')
+ORGANIZATION_TAG = addns('Organization')
+ATTRIBUTE_CONSUMING_SERVICE_TAG = addns('AttributeConsumingService')
+REQUESTED_ATTRIBUTE_TAG = addns('RequestedAttribute')
+CONTACT_PERSON_TAG = addns('ContactPerson')
+REGISTRATION_INFO_TAG = addns('RegistrationInfo', NAMESPACES['mdrpi'])
+REGISTRATION_POLICY_TAG = addns('RegistrationPolicy', NAMESPACES['mdrpi'])
+SCOPE_TAG = addns('Scope', NAMESPACES['shibmd'])
+ENTITY_ATTRIBUTES_TAG = addns('EntityAttributes', NAMESPACES['mdattr'])
+ATTRIBUTE_TAG = addns('Attribute', NAMESPACES['saml'])
+ATTRIBUTE_VALUE_TAG = addns('AttributeValue', NAMESPACES['saml'])
+X509_CERTIFICATE_TAG = addns('X509Certificate', XMLDSIG_NAMESPACE)
+
+UIINFO_FIELDS = {
+    addns('DisplayName', MDUI_NAMESPACE): 'displayName',
+    addns('Description', MDUI_NAMESPACE): 'description',
+    addns('InformationURL', MDUI_NAMESPACE): 'infoUrl',
+    addns('PrivacyStatementURL', MDUI_NAMESPACE): 'privacyUrl',
+}
+ORGANIZATION_FIELDS = {
+    addns('OrganizationName'): 'name',
+    addns('OrganizationDisplayName'): 'displayName',
+    addns('OrganizationURL'): 'URL',
+}
+CONTACT_FIELDS = {
+    addns('GivenName'): 'name',
+    addns('SurName'): 'surname',
+    addns('EmailAddress'): 'email',
+}
+DESCRIPTOR_TAGS = dict((addns(item), item) for item in DESCRIPTOR_TYPES)
+CATEGORY_ATTRIBUTE_NAMES = frozenset([
+    'http://macedir.org/entity-category-support',
+    'http://macedir.org/entity-category',
+    'urn:oasis:names:tc:SAML:attribute:assurance-certification',
+])
+
+# Tags visited by the single traversal, without and with entity details
+SINGLE_PASS_TAGS = tuple(DESCRIPTOR_TAGS.keys()) + (
+    addns('DisplayName', MDUI_NAMESPACE), REGISTRATION_INFO_TAG,
+    ATTRIBUTE_VALUE_TAG, X509_CERTIFICATE_TAG)
+SINGLE_PASS_DETAILS_TAGS = tuple(set(SINGLE_PASS_TAGS) | set(UIINFO_FIELDS.keys()) |
+                                 set(ORGANIZATION_FIELDS.keys()) | set(CONTACT_FIELDS.keys()) | set([
+                                     LOGO_TAG, REQUESTED_ATTRIBUTE_TAG, CONTACT_PERSON_TAG,
+                                     REGISTRATION_POLICY_TAG, SCOPE_TAG]))
+
+
+def _has_ancestors(node, root, *tags):
+    """
+    Tells if node has, below root, ancestors with the given tags.
+    Tags are listed from the innermost ancestor to the outermost one.
+    """
+    pos = 0
+    parent = node.getparent()
+    while parent is not None and parent is not root:
+        if parent.tag == tags[pos]:
+            pos += 1
+            if pos == len(tags):
+                return True
+        parent = parent.getparent()
+    return False
+
+
+def _is_category_value(node, root):
+    in_attribute = False
+    parent = node.getparent()
+    while parent is not None and parent is not root:
+        if not in_attribute:
+            in_attribute = parent.tag == ATTRIBUTE_TAG and \
+                parent.get('Name') in CATEGORY_ATTRIBUTE_NAMES
+        elif parent.tag == ENTITY_ATTRIBUTES_TAG:
+            return True
+        parent = parent.getparent()
+    return False
+
+# Start tag of an element, '>' characters inside quoted attributes allowed
+START_TAG_RE = re.compile(r'<([^\s>/!?][^\s>/]*)[^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>')
+ENTITY_START_TAG_RE = re.compile(r'<((?:[\w.-]+:)?EntityDescriptor)(?=[\s>/])[^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>')
+ENTITYID_ATTR_RE = re.compile(r'\sentityID\s*=\s*(?:"([^"]*)"|\'([^\']*)\')')
+XML_ENTITY_RE = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|amp|lt|gt|quot|apos);')
+XML_ENTITIES = {'amp': u'&', 'lt': u'<', 'gt': u'>', 'quot': u'"', 'apos': u"'"}
+
+INDEX_SUFFIX = '.index'
+INDEX_VERSION = 2
+
+# Salt of entity fingerprints, so that a new version of the extractors
+# makes every entity look changed
+FINGERPRINT_VERSION = '1'
+
+# Entity offset indexes already read by this process, by index file name
+_loaded_indexes = {}
+
+# Content digests computed by this process, by metadata file name
+_file_digests = {}
+
+
+class CertificateCache(object):
+    """
+    Bounded LRU cache of certificate signature hash algorithm names, keyed by
+    the SHA-256 digest of the base64 certificate body. It can be saved to and
+    loaded from a JSON file so that parsed certificates survive refreshes.
+    """
+
+    def __init__(self, maxsize=10000, filename=None):
+        self.maxsize = maxsize
+        self.filename = filename
+        self._entries = OrderedDict()
+        # Entries set are recorded only by the worker processes, which send
+        # them back to the parent one
+        self.track_added = False
+        self._added = []
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, digest):
+        with self._lock:
+            name = self._entries.pop(digest, None)
+            if name is None:
+                self.misses += 1
+                return None
+
+            self._entries[digest] = name
+            self.hits += 1
+            return name
+
+    def set(self, digest, name):
+        with self._lock:
+            self._entries.pop(digest, None)
+            self._entries[digest] = name
+            if self.track_added:
+                self._added.append((digest, name))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop_added(self):
+        """
+        Returns and forgets the entries set since the previous call.
+        """
+        with self._lock:
+            added, self._added = self._added, []
+        return added
+
+    def merge(self, hits, misses, entries):
+        """
+        Adds the statistics and new entries of another cache, e.g. the one
+        of a worker process.
+        """
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+        for digest, name in entries:
+            self.set(digest, name)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, filename=None):
+        self.filename = filename or self.filename
+        if not self.filename or not os.path.exists(self.filename):
+            return
+
+        with open(self.filename, 'r') as cache_file:
+            entries = json.load(cache_file)
+        for digest, name in entries[-self.maxsize:]:
+            self.set(digest, name)
+        self._added = []
+
+    def save(self):
+        if not self.filename:
+            return
+
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_filename = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmp_filename, 'w') as cache_file:
+            json.dump(self._entries.items(), cache_file)
+        os.rename(tmp_filename, self.filename)
+
+
+CERTIFICATE_CACHE = CertificateCache()
+
+# Entities sent to each worker process at a time by iter_entities
+WORKER_CHUNKSIZE = 16
+
+
+def _init_worker():
+    CERTIFICATE_CACHE.track_added = True
+    CERTIFICATE_CACHE.pop_added()
+
+
+def _extract_entity_fragment(args):
+    """
+    Worker process side of iter_entities: extracts the data of a serialized
+    EntityDescriptor. Certificate cache statistics and new entries are sent
+    back, as the cache of the worker is a copy of the parent one.
+    """
+    fragment, details = args
+    CERTIFICATE_CACHE.reset_stats()
+    parser = etree.XMLParser(huge_tree=True, remove_blank_text=True)
+    element = etree.fromstring(fragment, parser)
+    entity = MetadataParser._get_entity_from_element(element, details)
+    return (entity, CERTIFICATE_CACHE.hits, CERTIFICATE_CACHE.misses,
+            CERTIFICATE_CACHE.pop_added())
+
+
+def _unescape_attr(value):
+    def replace(match):
+        ref = match.group(1)
+        if ref.startswith('#x'):
+            return unichr(int(ref[2:], 16))
+        if ref.startswith('#'):
+            return unichr(int(ref[1:]))
+        return XML_ENTITIES[ref]
+
+    return XML_ENTITY_RE.sub(replace, value.decode('utf-8'))
+
+
+def _intern(value):
+    if isinstance(value, str):
+        return intern(value)
+    return value
+
+
+def _intern_keys(lang_dict):
+    return dict((_intern(lang), value) for lang, value in lang_dict.iteritems())
+
+
+# Entity values keyed by language code
+LANG_KEYS = ('displayName', 'description', 'infoUrl', 'privacyUrl',
+             'registration_policy', 'organization')
+
+
+def _compact_value(key, value):
+    if key in LANG_KEYS:
+        return _intern_keys(value)
+    if key == 'languages':
+        return frozenset(_intern(lang) for lang in value)
+    if key == 'logos':
+        return tuple(dict(logo, lang=_intern(logo['lang'])) for logo in value)
+    if key == 'attr_requested':
+        return dict((index, tuple(tuple(attr) for attr in attrs))
+                    for index, attrs in value.iteritems())
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+def _expand_value(key, value):
+    if key == 'languages':
+        return set(value)
+    if key in ('logos', 'contacts'):
+        return [dict(item) for item in value]
+    if key == 'attr_requested':
+        return dict((index, [list(attr) for attr in attrs])
+                    for index, attrs in value.iteritems())
+    if key in LANG_KEYS:
+        return dict(value)
+    if isinstance(value, tuple):
+        return list(value)
+    return value
+
+
+class ParsedEntity(object):
+    """
+    Data extracted from an EntityDescriptor. It is read as the entity dict
+    returned by former versions of MetadataParser (get, [], keys, copy),
+    but holds collections as tuples and only extracts the details from the
+    serialized entity the first time one of them is read. The fingerprint
+    identifies the content of the EntityDescriptor, it is not one of the keys.
+    """
+
+    BASE_KEYS = ('entityid', 'file_id', 'displayName', 'registration_authority',
+                 'registration_instant', 'entity_categories', 'entity_types',
+                 'protocols', 'certstats', 'languages', 'xml')
+    DETAIL_KEYS = ('description', 'infoUrl', 'privacyUrl', 'organization', 'logos',
+                   'scopes', 'attr_requested', 'contacts', 'registration_policy')
+    KEYS = BASE_KEYS + DETAIL_KEYS
+
+    __slots__ = BASE_KEYS + ('fingerprint', '_details')
+
+    def __init__(self, entity, xml=None, fingerprint=None):
+        for key, value in entity.iteritems():
+            setattr(self, key, _compact_value(key, value))
+        self.xml = xml
+        self.fingerprint = fingerprint
+        self._details = None
+
+    def _get_details(self):
+        if self._details is None:
+            parser = etree.XMLParser(huge_tree=True, remove_blank_text=True)
+            element = etree.fromstring(self.xml, parser)
+            entity = MetadataParser._get_entity_single_pass(element, True)
+            self._details = dict((key, _compact_value(key, entity[key]))
+                                 for key in self.DETAIL_KEYS + ('languages',) if key in entity)
+        return self._details
+
+    def __getitem__(self, key):
+        if self.xml is not None and (key in self.DETAIL_KEYS or key == 'languages'):
+            return self._get_details()[key]
+        if key not in self.BASE_KEYS:
+            raise KeyError(key)
+
+        try:
+            value = getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+        # Entities with details never had empty values
+        if (self.xml is not None and not value) or (key == 'xml' and value is None):
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return [key for key in self.KEYS if key in self]
+
+    def to_dict(self):
+        return dict((key, _expand_value(key, self[key])) for key in self.keys())
+
+    copy = to_dict
+
+    def __eq__(self, other):
+        if isinstance(other, ParsedEntity):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __getstate__(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__ if hasattr(self, key))
+
+    def __setstate__(self, state):
+        for key, value in state.iteritems():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return '<ParsedEntity %s>' % self.entityid
+
+
+class EntityCache(object):
+    """
+    Cache of parsed entities stored in a sqlite database, so that it is
+    shared by all the processes serving the site. Entries are keyed by the
+    digest of the metadata file content, a new version of the file replaces
+    the entries of the former one.
+    """
+
+    # Increased when the pickled entities change, the entries stored by
+    # former versions are then ignored
+    VERSION = 1
+
     def __init__(self, filename=None):
+        self.filename = filename
+        self._local = threading.local()
+
+    def _connect(self):
+        # sqlite connections can be used only by the thread, and the
+        # process, that opened them
+        local = self._local
+        if getattr(local, 'connection', None) is None or local.pid != os.getpid():
+            directory = os.path.dirname(self.filename)
+            if directory and not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Created meanwhile, or not writable and reported by sqlite
+                    pass
+            connection = sqlite3.connect(self.filename, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS %s ('
+                               'digest TEXT, entityid TEXT, details INTEGER, filename TEXT, data BLOB, '
+                               'PRIMARY KEY (digest, entityid, details))' % self._table)
+            local.connection = connection
+            local.pid = os.getpid()
+            local.purged = set()
+        return local.connection
+
+    @property
+    def _table(self):
+        return 'entities_v%d' % self.VERSION
+
+    def get(self, digest, entityid, details):
+        if not self.filename:
+            return None
+
+        try:
+            row = self._connect().execute(
+                'SELECT data FROM %s WHERE digest = ? AND entityid = ? AND details = ?' % self._table,
+                (digest, entityid, int(details))).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+
+        try:
+            return pickle.loads(str(row[0]))
+        except Exception:
+            # Unreadable entry, the entity is parsed again
+            return None
+
+    def set(self, digest, filename, entityid, details, entity):
+        if not self.filename:
+            return
+
+        try:
+            connection = self._connect()
+            if (filename, digest) not in self._local.purged:
+                connection.execute('DELETE FROM %s WHERE filename = ? AND digest <> ?' % self._table,
+                                   (filename, digest))
+                self._local.purged.add((filename, digest))
+            connection.execute('INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?)' % self._table,
+                               (digest, entityid, int(details), filename,
+                                sqlite3.Binary(pickle.dumps(entity, 2))))
+        except sqlite3.Error:
+            pass
+
+
+class MetadataParser(object):
+    def __init__(self, filename=None, entity_cache=None):
         if filename is None:
             raise ValueError('filename is required')
 
         self.filename = filename
-        with open(filename, 'r') as myfile:
-            data = myfile.read().replace('\n', '')
-        self.rootelem = etree.fromstring(data)
-        self.file_id = self.rootelem.get('ID', None)
-        self.is_federation = self.rootelem.tag == FEDERATION_ROOT_TAG
+        self.entity_cache = entity_cache
+        root_tag, self.root_attrib = self._read_root()
+        self.file_id = self.root_attrib.get('ID', None)
+        self.is_federation = root_tag == FEDERATION_ROOT_TAG
         self.is_entity = not self.is_federation
 
+    def _read_root(self):
+        # Only the start tag of the root element is read from the file
+        context = etree.iterparse(self.filename, events=('start',), huge_tree=True)
+        for _, element in context:
+            return element.tag, dict(element.attrib)
+        raise ValueError('Empty metadata file: %s' % self.filename)
+
+    @property
+    def rootelem(self):
+        """
+        Whole document tree, built the first time it is needed.
+        """
+        if not hasattr(self, '_rootelem'):
+            parser = etree.XMLParser(huge_tree=True, remove_blank_text=True)
+            self._rootelem = etree.parse(self.filename, parser).getroot()
+        return self._rootelem
+
     @staticmethod
     def _get_entity_details(element):
         entity = {}
@@ -105,88 +601,422 @@ class MetadataParser(object):
 
         return languages
 
+    @staticmethod
+    def entity_fingerprint(element):
+        canonical = etree.tostring(element, method='c14n')
+        return hashlib.sha1(FINGERPRINT_VERSION + canonical).hexdigest()
+
+    @staticmethod
+    def _get_entity_from_element(element, details):
+        entity = MetadataParser._get_entity_single_pass(element, False)
+        xml = etree.tostring(element, pretty_print=True) if details else None
+        return ParsedEntity(entity, xml, MetadataParser.entity_fingerprint(element))
+
+    @staticmethod
+    def _get_entity_single_pass(element, details):
+        """
+        Builds the entity dict with a single walk over the EntityDescriptor
+        subtree. The result is the same of _get_entity_by_features.
+        """
+        ui_info = {'displayName': {}, 'description': {}, 'infoUrl': {}, 'privacyUrl': {}}
+        organization = {}
+        logos = []
+        scopes = []
+        attr_requested = {'required': [], 'optional': []}
+        contacts = []
+        contact_nodes = {}
+        reg_info = None
+        reg_policy = {}
+        categories = []
+        types = []
+        protocols = {}
+        hashes = {}
+
+        tags = SINGLE_PASS_DETAILS_TAGS if details else SINGLE_PASS_TAGS
+        for node in element.iter(*tags):
+            tag = node.tag
+            if tag in UIINFO_FIELDS:
+                if _has_ancestors(node, element, UIINFO_TAG):
+                    ui_info[UIINFO_FIELDS[tag]][getlang(node)] = node.text
+            elif tag in CONTACT_FIELDS:
+                parent = node.getparent()
+                while parent is not None and parent is not element:
+                    if parent.tag == CONTACT_PERSON_TAG:
+                        contact, found = contact_nodes[parent]
+                        field = CONTACT_FIELDS[tag]
+                        if field not in found:
+                            found.add(field)
+                            contact[field] = node.text
+                    parent = parent.getparent()
+            elif tag == X509_CERTIFICATE_TAG:
+                cert_name = MetadataParser._certificate_hash(node.text)
+                hashes[cert_name] = hashes.get(cert_name, 0) + 1
+            elif tag in DESCRIPTOR_TAGS:
+                if node.getparent() is element:
+                    types.append(DESCRIPTOR_TAGS[tag])
+                if tag not in protocols and 'protocolSupportEnumeration' in node.attrib:
+                    protocols[tag] = node.attrib['protocolSupportEnumeration']
+            elif tag in ORGANIZATION_FIELDS:
+                parent = node.getparent()
+                if parent.tag == ORGANIZATION_TAG and parent is not element:
+                    lang_dict = organization.setdefault(getlang(node), {})
+                    lang_dict[ORGANIZATION_FIELDS[tag]] = node.text
+            elif tag == LOGO_TAG:
+                if node.text is not None and _has_ancestors(node, element, UIINFO_TAG):
+                    logos.append({
+                        'width': int(node.attrib.get('width', '0')),
+                        'height': int(node.attrib.get('height', '0')),
+                        'file': node.text,
+                        'lang': getlang(node),
+                    })
+            elif tag == REQUESTED_ATTRIBUTE_TAG:
+                if _has_ancestors(node, element, ATTRIBUTE_CONSUMING_SERVICE_TAG):
+                    required = node.attrib.get('isRequired', 'false')
+                    index = 'required' if required == 'true' else 'optional'
+                    attr_requested[index].append([node.attrib.get(
+                        'Name', None), node.attrib.get('FriendlyName', None)])
+            elif tag == CONTACT_PERSON_TAG:
+                contact = {'type': node.attrib.get('contactType', ''), 'name': None,
+                           'surname': None, 'email': None}
+                contacts.append(contact)
+                contact_nodes[node] = (contact, set())
+            elif tag == SCOPE_TAG:
+                if _has_ancestors(node, element, EXTENSIONS_TAG) and not node.text in scopes:
+                    scopes.append(node.text)
+            elif tag == ATTRIBUTE_VALUE_TAG:
+                if _is_category_value(node, element):
+                    categories.append(node.text.strip())
+            elif tag == REGISTRATION_INFO_TAG:
+                if reg_info is None and _has_ancestors(node, element, EXTENSIONS_TAG):
+                    reg_info = node
+            elif tag == REGISTRATION_POLICY_TAG:
+                lang = getlang(node)
+                if lang is not None and _has_ancestors(
+                        node, element, REGISTRATION_INFO_TAG, EXTENSIONS_TAG):
+                    reg_policy[lang] = node.text
+
+        for languages in ui_info.values() + [organization]:
+            languages.pop(None, None)
+
+        if not types:
+            types = ['AASSODescriptor']
+
+        entity = {}
+        entity['entityid'] = element.attrib['entityID']
+        entity['file_id'] = element.get('ID', None)
+        entity['displayName'] = ui_info['displayName']
+        if reg_info is not None:
+            entity['registration_authority'] = reg_info.attrib.get('registrationAuthority')
+            entity['registration_instant'] = reg_info.attrib.get('registrationInstant')
+        entity['entity_categories'] = categories
+        entity['entity_types'] = types
+        if addns(types[0]) in protocols:
+            entity['protocols'] = protocols[addns(types[0])].split(' ')
+        else:
+            entity['protocols'] = []
+        entity['certstats'] = json.dumps(hashes)
+
+        if details:
+            entity['xml'] = etree.tostring(element, pretty_print=True)
+            entity['description'] = ui_info['description']
+            entity['infoUrl'] = ui_info['infoUrl']
+            entity['privacyUrl'] = ui_info['privacyUrl']
+            entity['organization'] = organization
+            entity['logos'] = logos
+            entity['scopes'] = scopes
+            entity['attr_requested'] = attr_requested
+            entity['contacts'] = contacts
+            entity['registration_policy'] = reg_policy
+            entity = dict((k, v) for k, v in entity.iteritems() if v)
+
+        entity['languages'] = MetadataParser._entity_lang_seen(entity)
+        return entity
+
+    @staticmethod
+    def _get_entity_by_features(element, details):
+        entity = {}
+
+        entity['entityid'] = element.attrib['entityID']
+        entity['file_id'] = element.get('ID', None)
+        entity['displayName'] = MetadataParser.entity_displayname(element)
+        reg_info = MetadataParser.registration_information(element)
+        if reg_info and 'authority' in reg_info:
+            entity['registration_authority'] = reg_info['authority']
+        if reg_info and 'instant' in reg_info:
+            entity['registration_instant'] = reg_info['instant']
+        entity['entity_categories'] = MetadataParser.entity_categories(element)
+        entity['entity_types'] = MetadataParser.entity_types(element)
+        entity['protocols'] = MetadataParser.entity_protocols(
+            element, entity['entity_types'])
+        entity['certstats'] = MetadataParser.get_certstats(element)
+
+        if details:
+            entity_details = MetadataParser._get_entity_details(element)
+            entity.update(entity_details)
+            entity = dict((k, v) for k, v in entity.iteritems() if v)
+
+        entity['languages'] = MetadataParser._entity_lang_seen(entity)
+        return entity
+
+    @staticmethod
+    def _clear_element(element):
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
     @staticmethod
     def _get_entity_by_id(context, entityid, details):
         for _, element in context:
             if element.attrib['entityID'] == entityid:
-                entity = {}
-
-                entity['entityid'] = entityid
-                entity['file_id'] = element.get('ID', None)
-                entity['displayName'] = MetadataParser.entity_displayname(
-                    element)
-                reg_info = MetadataParser.registration_information(element)
-                if reg_info and 'authority' in reg_info:
-                    entity['registration_authority'] = reg_info['authority']
-                if reg_info and 'instant' in reg_info:
-                    entity['registration_instant'] = reg_info['instant']
-                entity['entity_categories'] = MetadataParser.entity_categories(
-                    element)
-                entity['entity_types'] = MetadataParser.entity_types(element)
-                entity['protocols'] = MetadataParser.entity_protocols(
-                    element, entity['entity_types'])
-                entity['certstats'] = MetadataParser.get_certstats(element)
-
-                if details:
-                    entity_details = MetadataParser._get_entity_details(
-                        element)
-                    entity.update(entity_details)
-                    entity = dict((k, v) for k, v in entity.iteritems() if v)
-
-                entity['languages'] = MetadataParser._entity_lang_seen(entity)
-                yield entity
+                yield MetadataParser._get_entity_from_element(element, details)
 
-            element.clear()
-            while element.getprevious() is not None:
-                del element.getparent()[0]
+            MetadataParser._clear_element(element)
         del context
 
+    def _iterparse(self):
+        return etree.iterparse(self.filename, tag=addns(
+            'EntityDescriptor'), events=('end',), huge_tree=True, remove_blank_text=True)
+
     def get_federation(self):
         assert self.is_federation
 
         federation = {}
-        federation['ID'] = self.rootelem.get('ID', None)
-        federation['Name'] = self.rootelem.get('Name', None)
+        federation['ID'] = self.root_attrib.get('ID', None)
+        federation['Name'] = self.root_attrib.get('Name', None)
 
         return federation
 
-    @staticmethod
-    def _chunkstring(string, length):
-        return (string[0 + i:length + i] for i in range(0, len(string), length))
+    def _index_filename(self):
+        return self.filename + INDEX_SUFFIX
+
+    def _file_stamp(self):
+        stat = os.stat(self.filename)
+        return [stat.st_size, stat.st_mtime]
+
+    def build_index(self):
+        """
+        Writes next to the metadata file an index with the byte offset and
+        length of every EntityDescriptor, keyed by entityID.
+        """
+        entities = {}
+        with open(self.filename, 'rb') as metadata_file:
+            data = mmap.mmap(metadata_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                root = START_TAG_RE.search(data)
+                if root is None or root.group(1).split(':')[-1] != 'EntitiesDescriptor':
+                    return False
+
+                header = root.end()
+                footer = '</%s>' % root.group(1)
+                pos = root.end()
+                while True:
+                    start = ENTITY_START_TAG_RE.search(data, pos)
+                    if start is None:
+                        break
+
+                    start_tag = start.group(0)
+                    if start_tag.endswith('/>'):
+                        end = start.end()
+                    else:
+                        end = data.find('</%s>' % start.group(1), start.end())
+                        if end < 0:
+                            break
+                        end += len(start.group(1)) + 3
+
+                    entityid = ENTITYID_ATTR_RE.search(start_tag)
+                    if entityid:
+                        value = entityid.group(1) if entityid.group(1) is not None else entityid.group(2)
+                        entities[_unescape_attr(value)] = [start.start(), end - start.start()]
+                    pos = end
+                digest = hashlib.md5(data).hexdigest()
+            finally:
+                data.close()
+
+        index = {
+            'version': INDEX_VERSION,
+            'stamp': self._file_stamp(),
+            'digest': digest,
+            'header': header,
+            'footer': footer,
+            'entities': entities,
+        }
+
+        index_filename = self._index_filename()
+        tmp_filename = '%s.%d.tmp' % (index_filename, os.getpid())
+        with open(tmp_filename, 'w') as index_file:
+            json.dump(index, index_file)
+        os.rename(tmp_filename, index_filename)
+        _loaded_indexes.pop(index_filename, None)
+        return True
+
+    def _load_index(self):
+        index_filename = self._index_filename()
+        try:
+            stamp = self._file_stamp()
+            index = _loaded_indexes.get(index_filename)
+            if index is None or index['stamp'] != stamp:
+                with open(index_filename, 'r') as index_file:
+                    index = json.load(index_file)
+                _loaded_indexes[index_filename] = index
+        except (IOError, OSError, ValueError):
+            return None
+
+        if index.get('version') != INDEX_VERSION or index['stamp'] != stamp:
+            return None
+        return index
+
+    def has_index(self):
+        return self._load_index() is not None
+
+    def file_digest(self):
+        """
+        Returns the MD5 digest of the file content, the same compared by
+        compare_filecontents when the file is fetched.
+        """
+        index = self._load_index()
+        if index is not None:
+            return index['digest']
+
+        stamp = self._file_stamp()
+        cached = _file_digests.get(self.filename)
+        if cached is None or cached[0] != stamp:
+            digest = hashlib.md5()
+            with open(self.filename, 'rb') as metadata_file:
+                for chunk in iter(lambda: metadata_file.read(1 << 20), ''):
+                    digest.update(chunk)
+            cached = (stamp, digest.hexdigest())
+            _file_digests[self.filename] = cached
+        return cached[1]
+
+    def _get_indexed_entity(self, index, entityid, details):
+        offset, length = index['entities'][entityid]
+        with open(self.filename, 'rb') as metadata_file:
+            data = mmap.mmap(metadata_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                fragment = data[:index['header']] + \
+                    data[offset:offset + length] + str(index['footer'])
+            finally:
+                data.close()
+
+        parser = etree.XMLParser(huge_tree=True, remove_blank_text=True)
+        element = etree.fromstring(fragment, parser).find(ENTITY_ROOT_TAG)
+        if element is None or element.attrib['entityID'] != entityid:
+            raise ValueError("Wrong index entry for entity: %s" % entityid)
+        return MetadataParser._get_entity_from_element(element, details)
 
     def get_entity(self, entityid, details=True):
-        context = etree.iterparse(self.filename, tag=addns(
-            'EntityDescriptor'), events=('end',), huge_tree=True, remove_blank_text=True)
-        element = None
-        for element in MetadataParser._get_entity_by_id(context, entityid, details):
-            return element
+        if self.entity_cache is None:
+            return self._get_entity(entityid, details)
+
+        digest = self.file_digest()
+        entity = self.entity_cache.get(digest, entityid, details)
+        if entity is None:
+            entity = self._get_entity(entityid, details)
+            if details:
+                # Store the details already extracted
+                entity.get('languages')
+            self.entity_cache.set(digest, self.filename, entityid, details, entity)
+        return entity
+
+    def _get_entity(self, entityid, details):
+        # The index is built by scanning the raw text, so markup such as a
+        # commented out EntityDescriptor can hide an entity or skew its
+        # offsets: anything not read from the index falls back to a full scan
+        index = self._load_index()
+        if index is not None and entityid in index['entities']:
+            try:
+                return self._get_indexed_entity(index, entityid, details)
+            except (ValueError, etree.XMLSyntaxError):
+                pass
+
+        # An entityID listed more than once resolves to its last
+        # EntityDescriptor, the one kept by the index and by the refresh
+        context = self._iterparse()
+        entity = None
+        for entity in MetadataParser._get_entity_by_id(context, entityid, details):
+            pass
+
+        if entity is None:
+            raise ValueError("Entity not found: %s" % entityid)
+        return entity
+
+    def _iter_entities_serial(self, details):
+        context = self._iterparse()
+        for _, element in context:
+            yield MetadataParser._get_entity_from_element(element, details)
+            MetadataParser._clear_element(element)
+        del context
+
+    def _iter_entity_fragments(self, details):
+        context = self._iterparse()
+        for _, element in context:
+            yield (etree.tostring(element, with_tail=False), details)
+            MetadataParser._clear_element(element)
+        del context
 
-        raise ValueError("Entity not found: %s" % entityid)
+    def _iter_entities_parallel(self, details, workers):
+        pool = multiprocessing.Pool(workers, _init_worker)
+        try:
+            results = pool.imap(_extract_entity_fragment,
+                                self._iter_entity_fragments(details), WORKER_CHUNKSIZE)
+            for entity, hits, misses, added in results:
+                CERTIFICATE_CACHE.merge(hits, misses, added)
+                yield entity
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def iter_entities(self, details=True, workers=None):
+        """
+        Yields the data of every entity in the file, in document order,
+        reading the file only once. With more than one worker, entities are
+        extracted by a pool of processes.
+        """
+        entity_ids = []
+        if workers and workers > 1:
+            entities = self._iter_entities_parallel(details, workers)
+        else:
+            entities = self._iter_entities_serial(details)
+
+        for entity in entities:
+            entity_ids.append(entity['entityid'])
+            yield entity
+
+        # The whole file has been read, entityid list comes for free
+        self._set_entity_ids(entity_ids)
+
+    def _set_entity_ids(self, entity_ids):
+        self._entity_ids = entity_ids
+        self._entity_id_set = frozenset(entity_ids)
 
     def entity_exist(self, entityid):
-        entity_xpath = self.rootelem.xpath("//md:EntityDescriptor[@entityID='%s']"
-                                           % entityid, namespaces=NAMESPACES)
-        return len(entity_xpath) > 0
+        return entityid in self.get_entity_id_set()
 
     @staticmethod
     def _get_entities_id(context):
         for _, element in context:
             yield element.attrib['entityID']
-            element.clear()
-            while element.getprevious() is not None:
-                del element.getparent()[0]
+            MetadataParser._clear_element(element)
         del context
 
     def get_entities(self):
         # Return entityid list
-        context = etree.iterparse(self.filename, tag=addns(
-            'EntityDescriptor'), events=('end',), huge_tree=True, remove_blank_text=True)
-        return list(self._get_entities_id(context))
+        if not hasattr(self, '_entity_ids'):
+            self._set_entity_ids(list(self._get_entities_id(self._iterparse())))
+        return list(self._entity_ids)
+
+    def get_entity_id_set(self):
+        """
+        Returns a frozenset of the entity IDs in the file, for membership tests.
+        """
+        if not hasattr(self, '_entity_id_set'):
+            self.get_entities()
+        return self._entity_id_set
 
     @staticmethod
     def entity_types(entity):
-        expression = "|".join([desc for desc in DESCRIPTOR_TYPES_UTIL])
-        elements = entity.xpath(expression, namespaces=NAMESPACES)
+        elements = XPATHS['entity_types'](entity)
         types = [element.tag.split("}")[1] for element in elements]
         if len(types) == 0:
             types = ['AASSODescriptor']
@@ -194,10 +1024,7 @@ class MetadataParser(object):
 
     @staticmethod
     def entity_categories(entity):
-        elements = entity.xpath(".//mdattr:EntityAttributes"
-                                "//saml:Attribute[@Name='http://macedir.org/entity-category-support' or @Name='http://macedir.org/entity-category' or @Name='urn:oasis:names:tc:SAML:attribute:assurance-certification']"
-                                "//saml:AttributeValue",
-                                namespaces=NAMESPACES)
+        elements = XPATHS['entity_categories'](entity)
         categories = [dnnode.text.strip() for dnnode in elements]
         return categories
 
@@ -208,9 +1035,10 @@ class MetadataParser(object):
         else:
             e_type = 'IDPSSODescriptor'
 
-        raw_protocols = entity.xpath(".//md:%s"
-                                     "/@protocolSupportEnumeration" % e_type,
-                                     namespaces=NAMESPACES)
+        protocols_xpath = XPATHS.get('protocols_%s' % e_type)
+        if protocols_xpath is None:
+            protocols_xpath = _xpath(".//md:%s/@protocolSupportEnumeration" % e_type)
+        raw_protocols = protocols_xpath(entity)
         if raw_protocols:
             protocols = raw_protocols[0]
             return protocols.split(' ')
@@ -218,23 +1046,49 @@ class MetadataParser(object):
         return []
 
     @staticmethod
-    def get_certstats(element):
+    def _certificate_hash(cert_text):
+        body = ''.join((cert_text or '').split())
+        digest = hashlib.sha256(body).hexdigest()
+        certName = CERTIFICATE_CACHE.get(digest)
+        if certName is not None:
+            return certName
+
+        certName = 'invalid'
+        try:
+            cert = x509.load_der_x509_certificate(
+                base64.b64decode(body), default_backend())
+            certName = cert.signature_hash_algorithm.name
+        except Exception, e:
+            pass
+
+        CERTIFICATE_CACHE.set(digest, certName)
+        return certName
+
+    def get_file_certstats(self):
+        """
+        Same as get_certstats on the root element, streaming the file
+        instead of building the whole document tree.
+        """
         hashes = {}
 
-        for x in element.xpath(".//ds:X509Certificate", namespaces=NAMESPACES):
-            certName = 'invalid'
+        context = etree.iterparse(self.filename, tag=(X509_CERTIFICATE_TAG, ENTITY_ROOT_TAG),
+                                  events=('end',), huge_tree=True, remove_blank_text=True)
+        for _, element in context:
+            if element.tag == X509_CERTIFICATE_TAG:
+                certName = MetadataParser._certificate_hash(element.text)
+                hashes[certName] = hashes.get(certName, 0) + 1
+            else:
+                MetadataParser._clear_element(element)
+        del context
+
+        return json.dumps(hashes)
 
-            try:
-                text = x.text.replace("\n", "").replace(
-                    " ", "").replace("\t", "")
-                text = "\n".join(MetadataParser._chunkstring(text, 64))
-                certText = "\n".join(
-                    ["-----BEGIN CERTIFICATE-----", text, '-----END CERTIFICATE-----'])
-                cert = x509.load_pem_x509_certificate(
-                    certText, default_backend())
-                certName = cert.signature_hash_algorithm.name
-            except Exception, e:
-                pass
+    @staticmethod
+    def get_certstats(element):
+        hashes = {}
+
+        for x in XPATHS['certificates'](element):
+            certName = MetadataParser._certificate_hash(x.text)
 
             if certName not in hashes:
                 hashes[certName] = 0
@@ -246,9 +1100,7 @@ class MetadataParser(object):
     def entity_displayname(entity):
         languages = {}
 
-        names = entity.xpath(".//mdui:UIInfo"
-                             "//mdui:DisplayName",
-                             namespaces=NAMESPACES)
+        names = XPATHS['displayname'](entity)
 
         for dn_node in names:
             lang = getlang(dn_node)
@@ -262,9 +1114,7 @@ class MetadataParser(object):
     def entity_description(entity):
         languages = {}
 
-        names = entity.xpath(".//mdui:UIInfo"
-                             "//mdui:Description",
-                             namespaces=NAMESPACES)
+        names = XPATHS['description'](entity)
 
         for dn_node in names:
             lang = getlang(dn_node)
@@ -278,9 +1128,7 @@ class MetadataParser(object):
     def entity_information_url(entity):
         languages = {}
 
-        names = entity.xpath(".//mdui:UIInfo"
-                             "//mdui:InformationURL",
-                             namespaces=NAMESPACES)
+        names = XPATHS['information_url'](entity)
 
         for dn_node in names:
             lang = getlang(dn_node)
@@ -294,9 +1142,7 @@ class MetadataParser(object):
     def entity_privacy_url(entity):
         languages = {}
 
-        names = entity.xpath(".//mdui:UIInfo"
-                             "//mdui:PrivacyStatementURL",
-                             namespaces=NAMESPACES)
+        names = XPATHS['privacy_url'](entity)
 
         for dn_node in names:
             lang = getlang(dn_node)
@@ -308,8 +1154,7 @@ class MetadataParser(object):
 
     @staticmethod
     def entity_organization(entity):
-        orgs = entity.xpath(".//md:Organization",
-                            namespaces=NAMESPACES)
+        orgs = XPATHS['organization'](entity)
         languages = {}
         for org_node in orgs:
             for attr in 'name', 'displayName', 'URL':
@@ -325,9 +1170,7 @@ class MetadataParser(object):
 
     @staticmethod
     def entity_logos(entity):
-        xmllogos = entity.xpath(".//mdui:UIInfo"
-                                "//mdui:Logo",
-                                namespaces=NAMESPACES)
+        xmllogos = XPATHS['logos'](entity)
         logos = []
         for logo_node in xmllogos:
             if logo_node.text is None:
@@ -342,9 +1185,7 @@ class MetadataParser(object):
 
     @staticmethod
     def registration_information(entity):
-        reg_info = entity.xpath(".//md:Extensions"
-                                "//mdrpi:RegistrationInfo",
-                                namespaces=NAMESPACES)
+        reg_info = XPATHS['registration_information'](entity)
         info = {}
         if reg_info:
             info['authority'] = reg_info[0].attrib.get('registrationAuthority')
@@ -353,10 +1194,7 @@ class MetadataParser(object):
 
     @staticmethod
     def registration_policy(entity):
-        reg_policy = entity.xpath(".//md:Extensions"
-                                  "//mdrpi:RegistrationInfo"
-                                  "//mdrpi:RegistrationPolicy",
-                                  namespaces=NAMESPACES)
+        reg_policy = XPATHS['registration_policy'](entity)
         languages = {}
         for dn_node in reg_policy:
             lang = getlang(dn_node)
@@ -369,9 +1207,7 @@ class MetadataParser(object):
 
     @staticmethod
     def entity_attribute_scope(entity):
-        scope_node = entity.xpath(".//md:Extensions"
-                                  "//shibmd:Scope",
-                                  namespaces=NAMESPACES)
+        scope_node = XPATHS['attribute_scope'](entity)
 
         scope = []
         for cur_scope in scope_node:
@@ -381,9 +1217,7 @@ class MetadataParser(object):
 
     @staticmethod
     def entity_requested_attributes(entity):
-        xmllogos = entity.xpath(".//md:AttributeConsumingService"
-                                "//md:RequestedAttribute",
-                                namespaces=NAMESPACES)
+        xmllogos = XPATHS['requested_attributes'](entity)
         attrs = {}
         attrs['required'] = []
         attrs['optional'] = []
@@ -396,23 +1230,21 @@ class MetadataParser(object):
 
     @staticmethod
     def entity_contacts(entity):
-        contacts = entity.xpath(".//md:ContactPerson",
-                                namespaces=NAMESPACES)
+        contacts = XPATHS['contacts'](entity)
         cont = []
         for cont_node in contacts:
             c_type = cont_node.attrib.get('contactType', '')
-            name = cont_node.xpath(".//md:GivenName", namespaces=NAMESPACES)
+            name = XPATHS['contact_name'](cont_node)
             if name:
                 name = name[0].text
             else:
                 name = None
-            surname = cont_node.xpath(".//md:SurName", namespaces=NAMESPACES)
+            surname = XPATHS['contact_surname'](cont_node)
             if surname:
                 surname = surname[0].text
             else:
                 surname = None
-            email = cont_node.xpath(
-                ".//md:EmailAddress", namespaces=NAMESPACES)
+            email = XPATHS['contact_email'](cont_node)
             if email:
                 email = email[0].text
             else:
@@ -219,6 +219,19 @@ AUTHENTICATION_BACKENDS = (
 
 PAGE_LENGTH = 25
 
+# Certificates already parsed by metadata refresh, saved between runs.
+# Keep it out of the directories served by the web server
+CERTIFICATE_CACHE_SIZE = 20000
+CERTIFICATE_CACHE_FILE = os.path.join(BASEDIR, 'met', 'cache', 'certificate-cache.json')
+
+# Parsed entities shared by all the processes, for each metadata file version.
+# Keep it out of the directories served by the web server
+ENTITY_CACHE_FILE = os.path.join(BASEDIR, 'met', 'cache', 'entity-cache.sqlite')
+
+# Local copies of the remote metadata sources, loaded when the source answers
+# that it has not been modified
+METADATA_SOURCES_DIR = os.path.join(BASEDIR, 'met', 'cache', 'sources')
+
 TOP_LENGTH = 3
 
 TEMPLATE_DIRS = (
@@ -281,3 +294,13 @@ STATS = {
     # Time format in the x axis
     'time_format': '%d/%m/%Y',
 }
+
+# Longer chart ranges are shown by week, month or year
+STATS_CHART_MAX_POINTS = 31
+
+# Page the entity lists by entityid instead of by page number, which does
+# not count the entities nor skip the rows of the previous pages
+ENTITY_KEYSET_PAGINATION = False
+
+# Entities shown in every page of the entity lists
+ENTITY_PAGE_SIZE = 20
@@ -0,0 +1,485 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+##########################################################################
+
+import os
+import stat
+import pytz
+import logging
+import shutil
+import tempfile
+from os import path
+import threading
+from datetime import date, datetime
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from met.metadataparser.models import (Federation, Entity, Entity_Federations, EntityStat,
+                                       DailyStat, StatRollup, RefreshCheckpoint, FederationSummary)
+from met.metadataparser.models.entity_stat import stats
+from met.metadataparser.refresh_metadata import refresh
+
+from tests.refresh.test_xmlparser import FEDERATION_FILE, ENTITY_IDS
+
+
+class FederationRefreshTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            CERTIFICATE_CACHE_FILE=path.join(self.media_root, 'certificate-cache.json'))
+        self.settings_override.enable()
+
+        federation = Federation(name='Test federation')
+        federation.save()
+        with open(FEDERATION_FILE) as metadata_file:
+            federation.file.save('test-metadata.xml', File(metadata_file), save=True)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def _refresh(self):
+        return Federation.objects.get().process_metadata_entities()
+
+    def test_first_refresh(self):
+        """
+        Tests that every entity of the file is added to the federation
+        """
+        self.assertEqual(self._refresh(), (0, len(ENTITY_IDS), 0))
+        self.assertEqual(sorted(Entity.objects.values_list('entityid', flat=True)), sorted(ENTITY_IDS))
+
+        membership = Entity_Federations.objects.get(entity__entityid=ENTITY_IDS[0])
+        self.assertEqual(str(membership.registration_instant), '2012-03-04')
+        self.assertEqual(membership.entity_categories.count(), 2)
+        self.assertEqual([unicode(t) for t in membership.entity.types.all()], ['IDP'])
+
+    def test_unchanged_entities(self):
+        """
+        Tests that entities with the same fingerprint are skipped
+        """
+        self._refresh()
+        Entity.objects.filter(entityid=ENTITY_IDS[1]).update(certstats='{}')
+        self.assertEqual(self._refresh(), (0, 0, 0))
+        self.assertEqual(Entity.objects.get(entityid=ENTITY_IDS[1]).certstats, '{}')
+
+    def test_modified_entities(self):
+        """
+        Tests that entities with a different fingerprint are processed again
+        """
+        self._refresh()
+        Entity.objects.filter(entityid=ENTITY_IDS[1]).update(certstats='{}')
+        Entity_Federations.objects.filter(entity__entityid=ENTITY_IDS[1]).update(fingerprint='changed')
+
+        membership = Entity_Federations.objects.get(entity__entityid=ENTITY_IDS[0])
+        membership.entity_categories.clear()
+        membership.fingerprint = None
+        membership.save()
+
+        self.assertEqual(self._refresh(), (0, 0, 2))
+        self.assertNotEqual(Entity.objects.get(entityid=ENTITY_IDS[1]).certstats, '{}')
+        self.assertEqual(membership.entity_categories.count(), 2)
+
+    def test_modified_entity_categories(self):
+        """
+        Tests that only the changed entity categories links are replaced
+        """
+        self._refresh()
+        membership = Entity_Federations.objects.get(entity__entityid=ENTITY_IDS[0])
+        EntityCategories = Entity_Federations.entity_categories.through
+        links = EntityCategories.objects.filter(entity_federations=membership)
+        kept, removed = links.order_by('id')
+        removed.delete()
+        membership.entity_categories.create(category_id='http://stale.example.org/category')
+        Entity_Federations.objects.filter(pk=membership.pk).update(fingerprint='changed')
+
+        self.assertEqual(self._refresh(), (0, 0, 1))
+        self.assertEqual(sorted(links.values_list('entitycategory__category_id', flat=True)),
+                         sorted([kept.entitycategory.category_id, removed.entitycategory.category_id]))
+        self.assertTrue(links.filter(pk=kept.pk).exists())
+
+    def test_modified_entity_types(self):
+        """
+        Tests that the missing entity types links are added once
+        """
+        self._refresh()
+        entity = Entity.objects.get(entityid=ENTITY_IDS[1])
+        types = sorted(entity.types.values_list('xmlname', flat=True))
+        entity.types.clear()
+        Entity_Federations.objects.filter(entity=entity).update(fingerprint='changed')
+
+        self.assertEqual(self._refresh(), (0, 0, 1))
+        self.assertEqual(sorted(entity.types.values_list('xmlname', flat=True)), types)
+
+    def test_duplicate_entities(self):
+        """
+        Tests that an entityID listed twice in the file is added once
+        """
+        with open(FEDERATION_FILE) as metadata_file:
+            metadata = metadata_file.read()
+        start = metadata.index('<md:EntityDescriptor entityID="%s"' % ENTITY_IDS[2])
+        end = metadata.index('</md:EntityDescriptor>', start) + len('</md:EntityDescriptor>')
+        metadata = metadata[:end] + metadata[start:end] + metadata[end:]
+
+        federation = Federation.objects.get()
+        federation.file.save('duplicate-metadata.xml', ContentFile(metadata), save=True)
+
+        self.assertEqual(self._refresh(), (0, len(ENTITY_IDS), 0))
+        self.assertEqual(Entity_Federations.objects.count(), len(ENTITY_IDS))
+        self.assertEqual(Entity.objects.get(entityid=ENTITY_IDS[2]).types.count(), 1)
+
+    def test_compute_new_stats(self):
+        """
+        Tests that entities are counted from the day after their registration
+        """
+        self._refresh()
+        federation = Federation.objects.get()
+        EntityStat.objects.create(federation=federation, feature='idp', value=0,
+                                  time=pytz.utc.localize(datetime(2012, 3, 2)))
+
+        computed, not_computed = federation.compute_new_stats()
+        self.assertEqual(computed['idp'], 1)
+        self.assertEqual(not_computed, [])
+
+        idp_stats = EntityStat.objects.filter(federation=federation, feature='idp')
+        values = dict((stat.time.date().isoformat(), stat.value) for stat in idp_stats)
+        self.assertEqual(values['2012-03-02'], 0)
+        self.assertEqual(values['2012-03-04'], 0)
+        self.assertEqual(values['2012-03-05'], 1)
+        self.assertEqual(idp_stats.filter(time__year=2012, time__month=3, time__day=4).count(), 1)
+
+        daily_stats = DailyStat.objects.filter(federation=federation)
+        self.assertEqual(daily_stats.count(), idp_stats.count())
+        self.assertEqual(daily_stats.get(date=date(2012, 3, 4)).idp, 0)
+        self.assertEqual(daily_stats.get(date=date(2012, 3, 5)).idp, 1)
+
+        rollups = StatRollup.objects.filter(federation=federation)
+        self.assertEqual(rollups.get(resolution='week', date=date(2012, 2, 27)).idp, 0)
+        self.assertEqual(rollups.get(resolution='week', date=date(2012, 3, 5)).idp, 1)
+        self.assertEqual(rollups.get(resolution='month', date=date(2012, 3, 1)).idp, 1)
+        self.assertEqual(rollups.get(resolution='year', date=date(2012, 1, 1)).idp, 1)
+
+        # The rollups of the last periods are replaced by the next computation
+        rollup_count = rollups.count()
+        federation.compute_new_stats()
+        self.assertEqual(rollups.count(), rollup_count)
+
+    def test_federation_summary(self):
+        """
+        Tests that the index page counts are read from the cached summary
+        """
+        self._refresh()
+        federation = Federation.objects.get()
+        federation.country = 'IT'
+        federation.save()
+        FederationSummary.update_all()
+
+        cache.clear()
+        with self.assertNumQueries(1):
+            summary = FederationSummary.get_summary()
+        with self.assertNumQueries(0):
+            self.assertEqual(FederationSummary.get_summary(), summary)
+
+        idps = Entity.objects.filter(types__xmlname='IDPSSODescriptor').count()
+        self.assertEqual(summary['counts']['All'], {federation.id: len(ENTITY_IDS)})
+        self.assertEqual(summary['counts']['IDPSSODescriptor'], {federation.id: idps})
+        self.assertEqual(summary['totals']['IDPSSODescriptor'], idps)
+        self.assertEqual(summary['countries'], {'IT': len(ENTITY_IDS)})
+
+    def test_federation_summary_changes(self):
+        """
+        Tests that the cached summary follows the changes of the federations
+        """
+        self._refresh()
+        federation = Federation.objects.get()
+        FederationSummary.update_all()
+
+        federation.country = 'IT'
+        federation.save()
+        self.assertEqual(FederationSummary.get_summary()['countries'], {'IT': len(ENTITY_IDS)})
+
+        federation.delete()
+        self.assertEqual(FederationSummary.get_summary()['counts']['All'], {})
+
+    def test_get_stat_counts(self):
+        """
+        Tests that the aggregate query counts the same entities of the getters
+        """
+        self._refresh()
+        federation = Federation.objects.get()
+        entities = Entity.objects.filter(federations=federation)
+        for ref_date in (None, pytz.utc.localize(datetime(2012, 3, 4)),
+                         pytz.utc.localize(datetime(2012, 3, 5))):
+            counts = federation.get_stat_counts(ref_date)
+            for feature, xml_name in stats['features'].items():
+                getter = getattr(federation, 'get_%s' % feature)
+                self.assertEqual(counts[feature], getter(entities, xml_name, ref_date))
+
+        self.assertEqual(federation.get_stat_counts()['idp'], 1)
+        self.assertEqual(federation.get_stat_counts(pytz.utc.localize(datetime(2012, 3, 4)))['idp'], 0)
+
+    @override_settings(REFRESH_ENTITY_BATCH_SIZE=2)
+    def test_entity_batches(self):
+        """
+        Tests that the checkpoint counts the entities of every committed batch
+        """
+        federation = Federation.objects.get()
+        checkpoint = RefreshCheckpoint.objects.create(federation=federation,
+                                                      run_started=timezone.now())
+        self.assertEqual(federation.process_metadata_entities(checkpoint=checkpoint),
+                         (0, len(ENTITY_IDS), 0))
+
+        checkpoint = RefreshCheckpoint.objects.get()
+        self.assertEqual((checkpoint.stage, checkpoint.processed, checkpoint.total),
+                         ('entities', len(ENTITY_IDS), len(ENTITY_IDS)))
+
+    def test_resume_refresh(self):
+        """
+        Tests that a resumed refresh updates only the interrupted federations
+        """
+        logger = logging.getLogger('tests.refresh')
+        refresh(force_refresh=True, logger=logger)
+        self.assertEqual(RefreshCheckpoint.objects.get().stage, 'done')
+        self.assertEqual(Entity.objects.count(), len(ENTITY_IDS))
+
+        refresh(logger=logger, resume=True)
+        Entity.objects.all().delete()
+        refresh(logger=logger, resume=True)
+        self.assertEqual(Entity.objects.count(), 0)
+
+        # The entities of an interrupted federation are updated even if
+        # its metadata file did not change
+        RefreshCheckpoint.objects.update(stage='entities')
+        refresh(logger=logger, resume=True)
+        self.assertEqual(RefreshCheckpoint.objects.get().stage, 'done')
+        self.assertEqual(Entity.objects.count(), len(ENTITY_IDS))
+
+    def test_failed_refresh(self):
+        """
+        Tests that a failed refresh keeps the progress it made
+        """
+        logger = logging.getLogger('tests.refresh')
+        federation = Federation.objects.get()
+        checkpoint = RefreshCheckpoint.objects.create(federation=federation,
+                                                      run_started=timezone.now())
+        checkpoint.set_stage('entities', len(ENTITY_IDS))
+        checkpoint.add_processed(2)
+        checkpoint.set_failed()
+        checkpoint = RefreshCheckpoint.objects.get()
+        self.assertEqual((checkpoint.stage, checkpoint.processed), ('failed', 2))
+
+        os.unlink(federation.file.path)
+        refresh(force_refresh=True, logger=logger)
+        self.assertEqual(RefreshCheckpoint.objects.get().stage, 'failed')
+
+    def test_removed_entities(self):
+        """
+        Tests that memberships of entities no more in the file are removed
+        """
+        self._refresh()
+        federation = Federation.objects.get()
+        entity = Entity.objects.create(entityid='https://gone.example.org')
+        membership = Entity_Federations.objects.create(entity=entity, federation=federation)
+        membership.entity_categories.create(category_id='http://gone.example.org/category')
+        other_federation = Federation.objects.create(name='Other federation')
+        Entity_Federations.objects.create(entity=entity, federation=other_federation)
+
+        self.assertEqual(federation.process_metadata_entities(), (1, 0, 0))
+        self.assertFalse(Entity_Federations.objects.filter(entity=entity, federation=federation).exists())
+        self.assertFalse(Entity_Federations.entity_categories.through.objects.filter(
+            entity_federations=membership.pk).exists())
+        self.assertEqual(Entity_Federations.objects.filter(federation=federation).count(),
+                         len(ENTITY_IDS))
+        # The entity is still listed by the other federation
+        self.assertTrue(Entity_Federations.objects.filter(entity=entity,
+                                                          federation=other_federation).exists())
+
+
+class ConcurrentRefreshTest(TransactionTestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+
+        for name in ('Test federation', 'Test interfederation'):
+            federation = Federation.objects.create(name=name)
+            with open(FEDERATION_FILE) as metadata_file:
+                federation.file.save('%s.xml' % federation.slug, File(metadata_file), save=True)
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_shared_entities(self):
+        """
+        Tests that federations adding the same new entities are refreshed
+        at the same time
+        """
+        # The in-memory test database is reachable only through the
+        # connection of the test, shared like LiveServerTestCase does
+        shared_connection = connections[DEFAULT_DB_ALIAS]
+        errors = []
+
+        def refresh_federation(federation):
+            connections[DEFAULT_DB_ALIAS] = shared_connection
+            try:
+                federation.process_metadata_entities()
+            except Exception, e:
+                errors.append(e)
+
+        shared_connection.allow_thread_sharing = True
+        try:
+            threads = [threading.Thread(target=refresh_federation, args=(federation,))
+                       for federation in Federation.objects.all()]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            shared_connection.allow_thread_sharing = False
+
+        self.assertEqual(errors, [])
+        self.assertEqual(Entity.objects.count(), len(ENTITY_IDS))
+        for federation in Federation.objects.all():
+            self.assertEqual(Entity_Federations.objects.filter(federation=federation).count(),
+                             len(ENTITY_IDS))
+
+
+METADATA = """<md:EntitiesDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata" Name="test">
+  <md:EntityDescriptor entityID="https://sp.example.org/shibboleth">
+    <md:SPSSODescriptor protocolSupportEnumeration="urn:oasis:names:tc:SAML:2.0:protocol">
+      <md:AssertionConsumerService Binding="urn:oasis:names:tc:SAML:2.0:bindings:HTTP-POST"
+                                   Location="https://sp.example.org/Shibboleth.sso/SAML2/POST" index="1"/>
+    </md:SPSSODescriptor>
+  </md:EntityDescriptor>
+</md:EntitiesDescriptor>
+"""
+
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    etags = {}
+    requests = []
+
+    def do_GET(self):
+        MetadataHandler.requests.append(self.headers.get('If-None-Match'))
+        etag = self.etags.get(self.path, '"v1"')
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(METADATA)))
+        self.end_headers()
+        self.wfile.write(METADATA)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetadataFetchTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.sources_dir = path.join(self.media_root, 'sources')
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root,
+                                                   METADATA_SOURCES_DIR=self.sources_dir)
+        self.settings_override.enable()
+
+        MetadataHandler.etags = {}
+        MetadataHandler.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), MetadataHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.url = 'http://127.0.0.1:%d/metadata.xml' % self.server.server_port
+        self.federation = Federation.objects.create(name='Test federation', slug='test',
+                                                    file_url=self.url)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_conditional_fetch(self):
+        """
+        Tests that validators are stored and a 304 skips the pipeline
+        """
+        self.assertTrue(self.federation.fetch_metadata_file('test'))
+        # pyFF loaded the downloaded copy instead of fetching the url again
+        self.assertEqual(MetadataHandler.requests, [None])
+        self.assertEqual(len(os.listdir(self.sources_dir)), 1)
+        self.federation.save()
+        self.assertEqual(Federation.objects.get().file_validators,
+                         {self.url: {'etag': '"v1"', 'last_modified': None}})
+
+        federation = Federation.objects.get()
+        self.assertFalse(federation.fetch_metadata_file('test'))
+        self.assertEqual(MetadataHandler.requests, [None, '"v1"'])
+
+    def test_stored_file(self):
+        """
+        Tests that the new file replaces the stored one, readable by the
+        web server
+        """
+        umask = os.umask(0)
+        os.umask(umask)
+        permissions = self.federation.file.storage.file_permissions_mode or (0666 & ~umask)
+
+        self.assertTrue(self.federation.fetch_metadata_file('test'))
+        file_path = self.federation.file.path
+        self.assertEqual(stat.S_IMODE(os.stat(file_path).st_mode), permissions)
+        self.assertEqual(os.listdir(path.dirname(file_path)), [path.basename(file_path)])
+        with open(file_path) as metadata_file:
+            self.assertIn('entityID="https://sp.example.org/shibboleth"', metadata_file.read())
+
+    def test_mixed_fetch(self):
+        """
+        Tests that not modified sources are loaded from their local copy
+        when other sources have been modified
+        """
+        other_url = 'http://127.0.0.1:%d/other.xml' % self.server.server_port
+        self.federation.file_url = '%s|%s;SP' % (self.url, other_url)
+        self.assertTrue(self.federation.fetch_metadata_file('test'))
+        self.federation.save()
+
+        MetadataHandler.etags = {'/other.xml': '"v2"'}
+        federation = Federation.objects.get()
+        federation.fetch_metadata_file('test')
+        self.assertEqual(MetadataHandler.requests, [None, None, '"v1"', '"v1"'])
+        self.assertEqual(Federation.objects.get().file_validators,
+                         {self.url: {'etag': '"v1"', 'last_modified': None},
+                          other_url: {'etag': '"v2"', 'last_modified': None}})
+        with open(federation.file.path) as metadata_file:
+            self.assertIn('entityID="https://sp.example.org/shibboleth"', metadata_file.read())
+
+        # A missing copy is downloaded again
+        shutil.rmtree(self.sources_dir)
+        MetadataHandler.requests = []
+        Federation.objects.get().fetch_metadata_file('test')
+        self.assertEqual(MetadataHandler.requests, [None, None])
+
+    def test_missing_file(self):
+        """
+        Tests that validators are not sent when the local file is missing
+        """
+        self.federation.file_validators = {self.url: {'etag': '"v1"'}}
+        self.assertTrue(self.federation.fetch_metadata_file('test'))
+        self.assertEqual(MetadataHandler.requests, [None])
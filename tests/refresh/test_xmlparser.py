@@ -0,0 +1,467 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+##########################################################################
+
+import pickle
+import shutil
+import sqlite3
+import threading
+import tempfile
+from os import path
+
+import simplejson as json
+
+from lxml import etree
+from django.test import SimpleTestCase
+
+from met.metadataparser.xmlparser import MetadataParser, ENTITY_ROOT_TAG, CERTIFICATE_CACHE, CertificateCache, \
+    ParsedEntity, EntityCache
+
+FEDERATION_FILE = path.join(path.dirname(__file__), 'data', 'federation-metadata.xml')
+
+# Entity whose features appear in places the extractors must ignore
+CORNER_CASES_ENTITY = """<md:EntityDescriptor xmlns:md="urn:oasis:names:tc:SAML:2.0:metadata"
+    xmlns:mdui="urn:oasis:names:tc:SAML:metadata:ui"
+    xmlns:mdrpi="urn:oasis:names:tc:SAML:metadata:rpi"
+    xmlns:mdattr="urn:oasis:names:tc:SAML:metadata:attribute"
+    xmlns:saml="urn:oasis:names:tc:SAML:2.0:assertion"
+    xmlns:shibmd="urn:mace:shibboleth:metadata:1.0"
+    entityID="https://corner.example.org">
+  <md:Extensions>
+    <mdrpi:RegistrationInfo registrationAuthority="http://first.example.org">
+      <mdrpi:RegistrationPolicy>http://no-lang.example.org</mdrpi:RegistrationPolicy>
+    </mdrpi:RegistrationInfo>
+    <mdrpi:RegistrationInfo registrationAuthority="http://second.example.org">
+      <mdrpi:RegistrationPolicy xml:lang="en">http://second.example.org/policy</mdrpi:RegistrationPolicy>
+    </mdrpi:RegistrationInfo>
+    <mdattr:EntityAttributes>
+      <saml:Attribute Name="http://macedir.org/entity-category">
+        <saml:AttributeValue>http://www.geant.net/uri/dataprotection-code-of-conduct/v1</saml:AttributeValue>
+      </saml:Attribute>
+    </mdattr:EntityAttributes>
+    <shibmd:Scope>corner.example.org</shibmd:Scope>
+  </md:Extensions>
+  <mdrpi:RegistrationPolicy xml:lang="it">http://outside.example.org</mdrpi:RegistrationPolicy>
+  <saml:Attribute Name="http://macedir.org/entity-category">
+    <saml:AttributeValue>http://outside.example.org/category</saml:AttributeValue>
+  </saml:Attribute>
+  <shibmd:Scope>outside.example.org</shibmd:Scope>
+  <mdui:DisplayName xml:lang="en">Outside UIInfo</mdui:DisplayName>
+  <md:SPSSODescriptor>
+    <md:Extensions>
+      <mdui:UIInfo>
+        <mdui:DisplayName xml:lang="en">First</mdui:DisplayName>
+        <mdui:DisplayName xml:lang="en">Second</mdui:DisplayName>
+        <mdui:Logo height="10" width="10" xml:lang="en"></mdui:Logo>
+      </mdui:UIInfo>
+    </md:Extensions>
+    <md:IDPSSODescriptor protocolSupportEnumeration="urn:nested"/>
+    <md:RequestedAttribute Name="urn:outside:service"/>
+  </md:SPSSODescriptor>
+  <md:SPSSODescriptor protocolSupportEnumeration=""/>
+  <md:Organization>
+    <md:OrganizationName xml:lang="en">First</md:OrganizationName>
+    <md:Extensions>
+      <md:OrganizationName xml:lang="en">Nested</md:OrganizationName>
+    </md:Extensions>
+  </md:Organization>
+  <md:Organization>
+    <md:OrganizationName xml:lang="en">Second</md:OrganizationName>
+    <md:OrganizationURL>http://no-lang.example.org</md:OrganizationURL>
+  </md:Organization>
+  <md:OrganizationName xml:lang="en">Outside</md:OrganizationName>
+  <md:ContactPerson>
+    <md:Extensions>
+      <md:GivenName></md:GivenName>
+    </md:Extensions>
+    <md:GivenName>Second</md:GivenName>
+  </md:ContactPerson>
+</md:EntityDescriptor>
+"""
+
+ENTITY_IDS = [
+    'https://idp.example.org/idp/shibboleth',
+    'https://sp.example.org/shibboleth',
+    "urn:example:o'brien:aa",
+]
+
+
+class MetadataParserTest(SimpleTestCase):
+    def setUp(self):
+        self.metadata = MetadataParser(filename=FEDERATION_FILE)
+
+    def test_lazy_root(self):
+        """
+        Tests that root attributes are available without building the tree
+        """
+        self.assertTrue(self.metadata.is_federation)
+        self.assertEqual(self.metadata.file_id, 'test-federation-20261018')
+        self.assertEqual(self.metadata.get_federation(),
+                         {'ID': 'test-federation-20261018',
+                          'Name': 'urn:mace:example.org:test-federation'})
+        self.assertFalse(hasattr(self.metadata, '_rootelem'))
+
+    def test_file_certstats(self):
+        """
+        Tests that streamed certificate stats match the ones of the whole tree
+        """
+        self.assertEqual(self.metadata.get_file_certstats(),
+                         MetadataParser.get_certstats(self.metadata.rootelem))
+
+    def test_get_entities(self):
+        """
+        Tests that entity IDs are listed in document order
+        """
+        self.assertEqual(self.metadata.get_entities(), ENTITY_IDS)
+
+    def test_iter_entities(self):
+        """
+        Tests that the streaming pass yields the same data as get_entity
+        """
+        for details in (False, True):
+            entities = list(self.metadata.iter_entities(details=details))
+            self.assertEqual([e['entityid'] for e in entities], ENTITY_IDS)
+            for entity in entities:
+                self.assertEqual(entity, self.metadata.get_entity(entity['entityid'], details))
+
+    def test_iter_entities_caches_ids(self):
+        """
+        Tests that a full streaming pass fills the entity ID list
+        """
+        list(self.metadata.iter_entities(details=False))
+        self.assertEqual(self.metadata._entity_ids, ENTITY_IDS)
+        self.assertEqual(self.metadata.get_entities(), ENTITY_IDS)
+
+    def test_iter_entities_workers(self):
+        """
+        Tests that a pool of worker processes yields the same data in the same order
+        """
+        for details in (False, True):
+            parallel = list(self.metadata.iter_entities(details=details, workers=2))
+            serial = list(self.metadata.iter_entities(details=details))
+            self.assertEqual(parallel, serial)
+            self.assertEqual([e.fingerprint for e in parallel], [e.fingerprint for e in serial])
+        self.assertEqual(self.metadata.get_entities(), ENTITY_IDS)
+
+    def test_entity_exist(self):
+        """
+        Tests entity lookups against the entityID set, quotes included
+        """
+        for entityid in ENTITY_IDS:
+            self.assertTrue(self.metadata.entity_exist(entityid))
+        self.assertFalse(self.metadata.entity_exist('https://unknown.example.org'))
+        self.assertFalse(self.metadata.entity_exist("']|//*[@entityID='"))
+        self.assertEqual(self.metadata.get_entity_id_set(), frozenset(ENTITY_IDS))
+        self.assertFalse(hasattr(self.metadata, '_rootelem'))
+
+
+class SinglePassExtractorTest(SimpleTestCase):
+    def _assert_same_extraction(self, element):
+        for details in (False, True):
+            self.assertEqual(MetadataParser._get_entity_single_pass(element, details),
+                             MetadataParser._get_entity_by_features(element, details))
+
+    def test_federation_entities(self):
+        """
+        Tests that the single traversal matches the per-feature extractors
+        """
+        for _, element in etree.iterparse(FEDERATION_FILE, tag=ENTITY_ROOT_TAG,
+                                          remove_blank_text=True):
+            self._assert_same_extraction(element)
+
+    def test_corner_cases(self):
+        """
+        Tests that features outside their expected context are ignored
+        in the same way by both extractors
+        """
+        element = etree.fromstring(CORNER_CASES_ENTITY)
+        self._assert_same_extraction(element)
+
+        entity = MetadataParser._get_entity_single_pass(element, True)
+        self.assertEqual(entity['displayName'], {'en': 'Second'})
+        self.assertEqual(entity['registration_authority'], 'http://first.example.org')
+        self.assertEqual(entity['registration_policy'], {'en': 'http://second.example.org/policy'})
+        self.assertEqual(entity['organization'], {'en': {'name': 'Second'}})
+        self.assertEqual(entity['entity_types'], ['SPSSODescriptor', 'SPSSODescriptor'])
+        self.assertEqual(entity['protocols'], [''])
+        self.assertEqual(entity['contacts'], [{'type': '', 'name': None,
+                                               'surname': None, 'email': None}])
+
+
+class ParsedEntityTest(SimpleTestCase):
+    def _iter_elements(self):
+        for _, element in etree.iterparse(FEDERATION_FILE, tag=ENTITY_ROOT_TAG,
+                                          remove_blank_text=True):
+            yield element
+
+    def test_dict_shape(self):
+        """
+        Tests that parsed entities convert to the dicts of the extractors
+        """
+        for element in self._iter_elements():
+            for details in (False, True):
+                entity = MetadataParser._get_entity_from_element(element, details)
+                expected = MetadataParser._get_entity_single_pass(element, details)
+                self.assertTrue(isinstance(entity, ParsedEntity))
+                self.assertEqual(entity.to_dict(), expected)
+                self.assertEqual(sorted(entity.keys()), sorted(expected.keys()))
+                for key, value in expected.iteritems():
+                    self.assertTrue(key in entity)
+                    self.assertEqual(entity.to_dict()[key], value)
+                self.assertEqual(entity.get('unknown'), None)
+
+    def test_fingerprint(self):
+        """
+        Tests that fingerprints change with the content of the EntityDescriptor only
+        """
+        fingerprints = [MetadataParser._get_entity_from_element(element, False).fingerprint
+                        for element in self._iter_elements()]
+        self.assertEqual(len(set(fingerprints)), len(ENTITY_IDS))
+
+        element = next(self._iter_elements())
+        entity = MetadataParser._get_entity_from_element(element, True)
+        self.assertEqual(entity.fingerprint, fingerprints[0])
+        element.set('validUntil', '2030-01-01T00:00:00Z')
+        self.assertNotEqual(MetadataParser.entity_fingerprint(element), fingerprints[0])
+
+    def test_lazy_details(self):
+        """
+        Tests that details are extracted only when first read
+        """
+        element = next(self._iter_elements())
+        entity = MetadataParser._get_entity_from_element(element, True)
+        self.assertEqual(entity.get('entityid'), ENTITY_IDS[0])
+        self.assertEqual(entity._details, None)
+        self.assertTrue(entity.get('contacts'))
+        self.assertNotEqual(entity._details, None)
+
+    def test_pickle(self):
+        """
+        Tests that parsed entities survive pickling, as done by worker processes
+        """
+        for element in self._iter_elements():
+            entity = MetadataParser._get_entity_from_element(element, True)
+            self.assertEqual(pickle.loads(pickle.dumps(entity, 2)), entity)
+
+
+class MetadataIndexTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        filename = path.join(self.tmpdir, 'federation-metadata.xml')
+        shutil.copy(FEDERATION_FILE, filename)
+        self.metadata = MetadataParser(filename=filename)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_build_index(self):
+        """
+        Tests that every entity of the file is indexed
+        """
+        self.assertFalse(self.metadata.has_index())
+        self.assertTrue(self.metadata.build_index())
+        self.assertTrue(self.metadata.has_index())
+        index = self.metadata._load_index()
+        self.assertEqual(sorted(index['entities'].keys()), sorted(ENTITY_IDS))
+
+    def test_indexed_get_entity(self):
+        """
+        Tests that entities read through the index match a full scan
+        """
+        expected = dict((e['entityid'], e) for e in self.metadata.iter_entities())
+        self.metadata.build_index()
+        for entityid in ENTITY_IDS:
+            self.assertEqual(self.metadata.get_entity(entityid), expected[entityid])
+        self.assertRaises(ValueError, self.metadata.get_entity, 'https://unknown.example.org')
+
+    def test_stale_index(self):
+        """
+        Tests that an index is ignored once the metadata file changes
+        """
+        self.metadata.build_index()
+        with open(self.metadata.filename, 'a') as metadata_file:
+            metadata_file.write('\n<!-- changed -->\n')
+        self.assertFalse(self.metadata.has_index())
+        self.assertEqual(self.metadata.get_entity(ENTITY_IDS[1])['entityid'], ENTITY_IDS[1])
+
+    def test_commented_entity(self):
+        """
+        Tests that entities missed by the index are found by a full scan
+        """
+        with open(FEDERATION_FILE) as metadata_file:
+            content = metadata_file.read()
+        content = content.replace('    <md:EntityDescriptor',
+                                  '    <!-- <md:EntityDescriptor entityID="https://old.example.org"> -->\n'
+                                  '    <md:EntityDescriptor', 1)
+        with open(self.metadata.filename, 'w') as metadata_file:
+            metadata_file.write(content)
+
+        self.metadata.build_index()
+        self.assertNotIn(ENTITY_IDS[0], self.metadata._load_index()['entities'])
+        self.assertEqual(self.metadata.get_entity(ENTITY_IDS[0])['entityid'], ENTITY_IDS[0])
+        self.assertRaises(ValueError, self.metadata.get_entity, 'https://old.example.org')
+
+    def test_duplicate_entity(self):
+        """
+        Tests that the last EntityDescriptor of a repeated entityID is read
+        with and without the index
+        """
+        with open(FEDERATION_FILE) as metadata_file:
+            content = metadata_file.read()
+        start = content.index('<md:EntityDescriptor entityID="%s"' % ENTITY_IDS[2])
+        end = content.index('</md:EntityDescriptor>', start) + len('</md:EntityDescriptor>')
+        duplicate = content[start:end].replace('https://aa.example.org/', 'https://aa2.example.org/')
+        content = content[:end] + '\n    ' + duplicate + content[end:]
+        with open(self.metadata.filename, 'w') as metadata_file:
+            metadata_file.write(content)
+
+        self.assertIn('https://aa2.example.org/', self.metadata.get_entity(ENTITY_IDS[2])['xml'])
+        self.metadata.build_index()
+        self.assertIn('https://aa2.example.org/', self.metadata.get_entity(ENTITY_IDS[2])['xml'])
+
+
+class EntityCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = path.join(self.tmpdir, 'federation-metadata.xml')
+        shutil.copy(FEDERATION_FILE, self.filename)
+        self.cache = EntityCache(path.join(self.tmpdir, 'entities.sqlite'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared_entities(self):
+        """
+        Tests that parsers of the same file version read cached entities
+        """
+        entity = MetadataParser(filename=self.filename, entity_cache=self.cache).get_entity(ENTITY_IDS[0])
+
+        metadata = MetadataParser(filename=self.filename, entity_cache=self.cache)
+        digest = metadata.file_digest()
+        self.assertEqual(self.cache.get(digest, ENTITY_IDS[0], True), entity)
+        self.assertEqual(self.cache.get(digest, ENTITY_IDS[0], False), None)
+        self.assertEqual(metadata.get_entity(ENTITY_IDS[0]), entity)
+
+    def test_new_file_version(self):
+        """
+        Tests that a changed file is parsed again and replaces former entries
+        """
+        metadata = MetadataParser(filename=self.filename, entity_cache=self.cache)
+        metadata.get_entity(ENTITY_IDS[1], False)
+        old_digest = metadata.file_digest()
+
+        with open(self.filename, 'a') as metadata_file:
+            metadata_file.write('\n<!-- changed -->\n')
+        metadata = MetadataParser(filename=self.filename, entity_cache=self.cache)
+        self.assertNotEqual(metadata.file_digest(), old_digest)
+        self.assertEqual(metadata.get_entity(ENTITY_IDS[1], False)['entityid'], ENTITY_IDS[1])
+        self.assertEqual(self.cache.get(old_digest, ENTITY_IDS[1], False), None)
+
+    def test_threads(self):
+        """
+        Tests that every thread reads the entities cached by the others
+        """
+        metadata = MetadataParser(filename=self.filename, entity_cache=self.cache)
+        entity = metadata.get_entity(ENTITY_IDS[0])
+        digest = metadata.file_digest()
+
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+            self.cache.get(digest, ENTITY_IDS[0], True)))
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [entity])
+
+    def test_unreadable_entry(self):
+        """
+        Tests that an entry that cannot be unpickled is parsed again
+        """
+        metadata = MetadataParser(filename=self.filename, entity_cache=self.cache)
+        digest = metadata.file_digest()
+        self.cache.set(digest, self.filename, ENTITY_IDS[0], True, None)
+        self.cache._connect().execute('UPDATE %s SET data = ?' % self.cache._table,
+                                      (sqlite3.Binary('not a pickle'),))
+
+        self.assertEqual(self.cache.get(digest, ENTITY_IDS[0], True), None)
+        self.assertEqual(metadata.get_entity(ENTITY_IDS[0])['entityid'], ENTITY_IDS[0])
+
+    def test_index_digest(self):
+        """
+        Tests that the digest stored in the index is the one of the file
+        """
+        metadata = MetadataParser(filename=self.filename)
+        digest = metadata.file_digest()
+        metadata.build_index()
+        self.assertEqual(metadata._load_index()['digest'], digest)
+
+
+class CertificateCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lru_eviction(self):
+        """
+        Tests that the least recently used certificates are evicted first
+        """
+        cache = CertificateCache(maxsize=2)
+        cache.set('a', 'sha1')
+        cache.set('b', 'sha256')
+        self.assertEqual(cache.get('a'), 'sha1')
+        cache.set('c', 'sha512')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'sha1')
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_save_and_load(self):
+        """
+        Tests that cached certificates survive through the cache file
+        """
+        filename = path.join(self.tmpdir, 'cache', 'certificates.json')
+        cache = CertificateCache(filename=filename)
+        cache.set('a', 'sha1')
+        cache.save()
+
+        loaded = CertificateCache()
+        loaded.load(filename)
+        self.assertEqual(loaded.get('a'), 'sha1')
+
+    def test_added_entries(self):
+        """
+        Tests that only the worker processes record the entries they set
+        """
+        cache = CertificateCache()
+        cache.set('a', 'sha1')
+        self.assertEqual(cache.pop_added(), [])
+
+        cache.track_added = True
+        cache.set('b', 'sha256')
+        self.assertEqual(cache.pop_added(), [('b', 'sha256')])
+
+        metadata = MetadataParser(filename=FEDERATION_FILE)
+        list(metadata.iter_entities(details=False, workers=2))
+        self.assertEqual(CERTIFICATE_CACHE.pop_added(), [])
+
+    def test_certstats_hits(self):
+        """
+        Tests that certificates shared by entities are parsed once
+        """
+        metadata = MetadataParser(filename=FEDERATION_FILE)
+        CERTIFICATE_CACHE.reset_stats()
+        certstats = [e['certstats'] for e in metadata.iter_entities(details=False)]
+        self.assertEqual(json.loads(certstats[1]), {'sha256': 1, 'invalid': 1})
+        self.assertTrue(CERTIFICATE_CACHE.hits >= 1)
+
+        misses = CERTIFICATE_CACHE.misses
+        list(metadata.iter_entities(details=False))
+        self.assertEqual(CERTIFICATE_CACHE.misses, misses)
@@ -0,0 +1,156 @@
+#################################################################
+# MET v2 Metadate Explorer Tool
+#
+# This Software is Open Source. See License: https://github.com/TERENA/met/blob/master/LICENSE.md
+# Copyright (c) 2012, TERENA All rights reserved.
+#
+# This Software is based on MET v1 developed for TERENA by Yaco Sistemas, http://www.yaco.es/
+# MET v2 was developed for TERENA by Tamim Ziai, DAASI International GmbH, http://www.daasi.de
+# Current version of MET has been revised for performance improvements by Andrea Biancini,
+# Consortium GARR, http://www.garr.it
+##########################################################################
+
+import copy
+import pytz
+import shutil
+import tempfile
+from os import path
+from datetime import date, datetime
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.core.files import File
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from met.metadataparser.models import Federation, Entity, EntityStat, DailyStat, FederationSummary
+
+from tests.refresh.test_xmlparser import FEDERATION_FILE, ENTITY_IDS
+
+
+def _chart_data(from_date, to_date):
+    data = {}
+    for field, day in (('fromDate', from_date), ('toDate', to_date)):
+        data.update({'%s_year' % field: day.year, '%s_month' % field: day.month,
+                     '%s_day' % field: day.day})
+    return data
+
+
+class FederationViewTest(TestCase):
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            CERTIFICATE_CACHE_FILE=path.join(self.media_root, 'certificate-cache.json'))
+        self.settings_override.enable()
+
+        self.federation = Federation.objects.create(name='Test federation')
+        with open(FEDERATION_FILE) as metadata_file:
+            self.federation.file.save('test-metadata.xml', File(metadata_file), save=True)
+        self.federation.process_metadata_entities()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+
+class EntityPaginationTest(FederationViewTest):
+    @override_settings(ENTITY_PAGE_SIZE=2)
+    def test_keyset_pagination(self):
+        """
+        Tests that the entity pages follow each other in entityid order
+        """
+        # The forms imported by the views query the database at import time
+        from met.metadataparser.views import _keyset_paginate_fed
+
+        pages = []
+        pagination = _keyset_paginate_fed(Entity.objects.all())
+        while True:
+            pages.append([entity.entityid for entity in pagination['objects']])
+            if not pagination['next_cursor']:
+                break
+            pagination = _keyset_paginate_fed(Entity.objects.all(), after=pagination['next_cursor'])
+        self.assertEqual(sum(pages, []), sorted(ENTITY_IDS))
+
+        pagination = _keyset_paginate_fed(Entity.objects.all(), before=pagination['previous_cursor'])
+        self.assertEqual([entity.entityid for entity in pagination['objects']], pages[-2])
+
+    @override_settings(ENTITY_PAGE_SIZE=2, ENTITY_KEYSET_PAGINATION=True)
+    def test_federation_view(self):
+        """
+        Tests that the federation page shows the total of the summary
+        """
+        FederationSummary.update_all()
+        response = self.client.get(self.federation.get_absolute_url())
+        self.assertEqual(response.context['pagination']['num_objects'], len(ENTITY_IDS))
+        self.assertEqual(response.context['pagination']['next_cursor'], sorted(ENTITY_IDS)[1])
+
+
+class FederationChartsTest(FederationViewTest):
+    def setUp(self):
+        super(FederationChartsTest, self).setUp()
+        self.url = reverse('federation_charts', args=[self.federation.slug])
+        self.data = _chart_data(date(2013, 3, 1), date(2013, 3, 5))
+
+    def test_chart_stats(self):
+        """
+        Tests that long chart ranges are read from the rollups
+        """
+        # The forms imported by the views query the database at import time
+        from met.metadataparser.views import _get_chart_stats
+
+        EntityStat.objects.create(federation=self.federation, feature='idp', value=0,
+                                  time=pytz.utc.localize(datetime(2012, 3, 2)))
+        self.federation.compute_new_stats()
+
+        chart_stats = _get_chart_stats(self.federation, date(2012, 3, 1), date(2012, 3, 31))
+        self.assertEqual(chart_stats.model, DailyStat)
+        self.assertEqual(chart_stats.count(), 30)
+
+        chart_stats = _get_chart_stats(self.federation, date(2012, 3, 1), date(2012, 6, 30))
+        self.assertEqual([(stat.resolution, stat.date) for stat in chart_stats][:2],
+                         [('week', date(2012, 2, 27)), ('week', date(2012, 3, 5))])
+
+        chart_stats = _get_chart_stats(self.federation, date(2012, 3, 1), date(2014, 6, 30))
+        self.assertEqual(chart_stats[0].resolution, 'month')
+
+    def test_chart_max_points(self):
+        """
+        Tests that the chart resolution follows the maximum number of points
+        """
+        # The forms imported by the views query the database at import time
+        from met.metadataparser.views import _get_chart_stats
+
+        EntityStat.objects.create(federation=self.federation, feature='idp', value=0,
+                                  time=pytz.utc.localize(datetime(2012, 3, 2)))
+        self.federation.compute_new_stats()
+
+        with override_settings(STATS_CHART_MAX_POINTS=10):
+            chart_stats = _get_chart_stats(self.federation, date(2012, 3, 1), date(2012, 3, 31))
+            self.assertEqual(chart_stats[0].resolution, 'week')
+
+        with override_settings(STATS_CHART_MAX_POINTS=200):
+            chart_stats = _get_chart_stats(self.federation, date(2012, 3, 1), date(2012, 6, 30))
+            self.assertEqual(chart_stats.model, DailyStat)
+
+    def test_charts(self):
+        """
+        Tests that the charts read a row for every day
+        """
+        DailyStat.objects.create(federation=self.federation, date=date(2013, 3, 2), idp=3)
+        response = self.client.post(self.url, self.data)
+        self.assertEqual([row['idp'] for row in response.context['s_chart']], [3])
+
+    def test_unknown_terms(self):
+        """
+        Tests that configured terms without daily statistics are reported
+        """
+        stats = copy.deepcopy(settings.STATS)
+        stats['statistics']['entity_by_type']['terms'].append('unknown')
+        with override_settings(STATS=stats):
+            response = self.client.post(self.url, self.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('s_chart', response.context)
+        self.assertIn('unknown', [unicode(m) for m in get_messages(response.wsgi_request)][0])